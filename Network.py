@@ -1,20 +1,49 @@
 import numpy as np
+import activations
+import optimizers
+import profiler
 np.random.seed(222)
 
 # parameters for initialization
 INIT_MEAN = 0.0
 INIT_STD = 0.01
-MIN_LR = 0.0001
-LR_SCALE = 2
 MAX_MOMENTUM = 0.9
 MOMENTUM_SCALE = 0.2
-EPSILON = 10 ** -8
+
+# block power iteration of the spectral norm monitoring
+NORM_BLOCK = 8  # vectors iterated together, more vectors converge faster when the top singular values are close
+NORM_ITERATIONS = 50  # max iterations, a warm start usually converges in a few
+NORM_TOLERANCE = 10 ** -4  # relative change of the eigenvalue estimate to stop at
+
+# compute and master weights data types of each precision mode
+DTYPES = {"float64": (np.float64, np.float64), "float32": (np.float32, np.float32), "mixed": (np.float32, np.float64)}
+
+def max_eigenval(weights, vecs=None, seed=0):
+    # block power iteration on W^T W with rayleigh-ritz, warm started from vecs of a previous call
+    # returns the largest eigenvalue of W W^T and the vectors to warm start the next call from
+    if vecs is None:
+        block = min(NORM_BLOCK, weights.shape[1])
+        vecs = np.random.default_rng(seed).standard_normal((weights.shape[1], block))  # own stream, training randomness is untouched
+    eigenval = 0.0
+    for _ in range(NORM_ITERATIONS):
+        vecs = np.linalg.qr(vecs)[0]
+        proj = np.dot(weights, vecs.astype(weights.dtype))
+        gram = np.dot(proj.transpose(), proj).astype(np.float64)  # V^T W^T W V
+        new_eigenval = float(np.linalg.eigvalsh(gram)[-1])
+        vecs = np.dot(weights.transpose(), proj).astype(np.float64)
+        converged = abs(new_eigenval - eigenval) <= NORM_TOLERANCE * new_eigenval
+        eigenval = new_eigenval
+        if converged:
+            break
+    return eigenval, vecs
+
 
 class Fully_Connected:
+    stack_shape = ()  # leading axes of the weights and buffers, a stack of models has one
 
     def __init__(self, nn_params):
         self.model = nn_params["model"]
-        self.optimizer = nn_params["optimizer"]
+        self.optimizer = optimizers.get_optimizer(nn_params["optimizer"])
         self.initial_lr = nn_params["lr"]  # initial learning rate
         self.lr = nn_params["lr"]  # learning rates
         self.momentum = nn_params["momentum"]
@@ -27,113 +56,167 @@ class Fully_Connected:
         self.dropout = nn_params["dropout"]  # a list of dropout probability per layer
         self.layers = nn_params["layers"]  # list of layers size
         self.activation_functions = nn_params["activations"]  # list of activation functions
+        self.activation_kernels = [activations.get_activation(name) for name in self.activation_functions]
+        self.dtype, self.master_dtype = (np.dtype(t) for t in DTYPES[nn_params["dtype"]])  # compute and master weights dtypes
 
         self.is_train = True
+        self.buffers = {}  # per batch size forward buffers
         self.activations = []  # activations
+        self.pre_activations = []  # linear transformation of each layer
         self.mask = []  # dropout mask
+        self.output = None  # network output
 
         # data structures for saving weights and gradients of each layer
-        self.weights = [np.random.normal(INIT_MEAN, INIT_STD, (prev_layer + 1, next_layer)) for prev_layer, next_layer in zip(self.layers, self.layers[1:])]
-        self.grads = [np.zeros((prev_layer + 1, next_layer)) for prev_layer, next_layer in zip(self.layers, self.layers[1:])]
-        self.accum_grads = [np.zeros((prev_layer + 1, next_layer)) for prev_layer, next_layer in zip(self.layers, self.layers[1:])]
-        self.sec_accum_grads = [np.zeros((prev_layer + 1, next_layer)) for prev_layer, next_layer in zip(self.layers, self.layers[1:])]
+        self.weights = [np.random.normal(INIT_MEAN, INIT_STD, shape).astype(self.master_dtype) for shape in self.param_shapes()]
+        self.grads = [np.zeros(shape, dtype=self.dtype) for shape in self.param_shapes()]
+        self.reg_grads = None  # regularization gradients, allocated by the first backward pass that adds them
+        self.accum_grads = [np.zeros(shape, dtype=self.master_dtype) for shape in self.param_shapes()]
+        self.sec_accum_grads = [np.zeros(shape, dtype=self.master_dtype) for shape in self.param_shapes()]
         self.logits = 0  # diff between each value an max value on final layer
 
+        # weights used by forward and backward, a lower precision copy of the master weights in mixed mode
+        self.compute_weights = self.weights if self.dtype == self.master_dtype else [w.astype(self.dtype) for w in self.weights]
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31))  # dropout random stream
+        self.norm_vectors = [None] * (int(np.prod(self.stack_shape)) * (len(self.layers) - 1))  # top right singular vectors estimate of each matrix, member major in a stack
+        self.masks = None  # pruning masks of the weights, pruned weights stay zero through the optimizer steps
+
+        # instrumentation, the default profiler is disabled
+        self.profiler = profiler.NULL
+        self.sections = [("forward_dropout_" + str(layer_num + 1), "forward_gemm_" + str(layer_num + 1), "forward_activation_" + str(layer_num + 1)) for layer_num in range(len(self.layers) - 1)]
+
+    def param_shapes(self):
+        # weights shape of each layer, with a bias row
+        return [self.stack_shape + (prev_layer + 1, next_layer) for prev_layer, next_layer in zip(self.layers, self.layers[1:])]
+
+    def init_buffers(self, batch_size):
+        # activation, pre-activation, mask and output buffers are allocated once per batch size
+        if batch_size not in self.buffers:
+            stack = self.stack_shape
+            activations = [np.empty(stack + (layer + 1, batch_size), dtype=self.dtype) for layer in self.layers[:-1]]  # layer inputs with a bias row
+            for act in activations:
+                act[..., 0, :] = 1.0
+            pre_activations = [np.empty(stack + (layer, batch_size), dtype=self.dtype) for layer in self.layers[1:]]  # z = Wx
+            mask = [np.empty(stack + (layer, batch_size), dtype=self.dtype) for layer in self.layers[:-1]]
+            output = np.empty(stack + (self.layers[-1], batch_size), dtype=self.dtype)
+            caches = [kernel.new_cache(layer, batch_size, self.dtype, stack) for kernel, layer in zip(self.activation_kernels, self.layers[1:])]  # derivative state of each activation
+            output_delta = np.empty(stack + (self.layers[-1], batch_size), dtype=self.dtype)  # gradient of the loss on the last layer input
+            self.buffers[batch_size] = (activations, pre_activations, mask, output, caches, output_delta)
+        self.activations, self.pre_activations, self.mask, self.output, self.caches, self.output_delta = self.buffers[batch_size]
+        self.log_norm = self.caches[-1]  # log-sum-exp of the shifted softmax input
+
     def forward(self, x):
         # x - matrix of examples. Each example in a column
-        batch_size = np.size(x, 1)
+        # the returned output buffer is overwritten by the next forward pass
+        self.init_buffers(np.size(x, 1))
 
-        out = x.copy()  # copy input
+        self.activations[0][..., 1:, :] = x  # copy input below the bias row, of every model of a stack
         for layer_num in range(len(self.layers) - 1):
+            act = self.activations[layer_num]
+            dropout_section, gemm_section, activation_section = self.sections[layer_num]
 
             # dropout in training time only
+            # a stack has a (K, 1, 1) dropout of each layer
             success_prob = 1 - self.dropout[layer_num]  # 0.2 dropout is 0.2 success = ~0.8 should of neurons should not be zeroed out
-            if self.is_train:
-                dmask = np.random.binomial(n=1, p=success_prob, size=out.shape) / success_prob
-                out = out * dmask   # element wise multiplication by the mask and scaling output
-                self.mask.append(dmask)  # save mask for backprop phase
-
-            # add bias to layer and save activations
-            out = np.concatenate((np.ones(batch_size).reshape(1, -1), out), axis=0)
-            self.activations.append(out.copy())
+            if self.is_train and np.any(self.dropout[layer_num] > 0):
+                with self.profiler.section(dropout_section):
+                    dmask = self.mask[layer_num]
+                    self.rng.random(out=dmask, dtype=self.dtype)
+                    np.less(dmask, success_prob, out=dmask)  # 1 with probability success_prob
+                    dmask /= success_prob
+                    act[..., 1:, :] *= dmask   # element wise multiplication by the mask and scaling output
 
             # linear transformation
-            out = np.dot(self.weights[layer_num].transpose(), out)  # z = Wx
-
-            # non linearity
-            if self.activation_functions[layer_num] == "relu":
-                out = np.maximum(out, 0)  # a = relu(z, 0)
-            elif self.activation_functions[layer_num] == "tanh":
-                out = np.tanh(out)  # a = tanh(z)
-            elif self.activation_functions[layer_num] == "softmax":
-                max_val = np.max(out, axis=0)  # find the max valued class in each column (example)
-                self.logits = out - max_val
-                e_x = np.exp(self.logits)  # subtract max_val from all values of each example to prevent overflow
-                out = e_x/np.sum(e_x, axis=0)
-
-        return out.copy()
+            out = self.pre_activations[layer_num]
+            with self.profiler.section(gemm_section):
+                np.matmul(self.compute_weights[layer_num].swapaxes(-1, -2), act, out=out)  # z = Wx, a batched matmul for a stack
+
+            # non linearity, written below the bias row of the next layer input
+            # the derivative state is cached in training only, the output layer always keeps it for the loss
+            is_last = layer_num == len(self.layers) - 2
+            next_act = self.output if is_last else self.activations[layer_num + 1][..., 1:, :]
+            cache = self.caches[layer_num] if self.is_train or is_last else None
+            with self.profiler.section(activation_section):
+                self.activation_kernels[layer_num].forward(out, next_act, cache)
+            if is_last:
+                self.logits = out  # diff between each value an max value
+
+        return self.output
 
     def backward(self, batched_data, net_out, labels):
 
-        # activations point derivative
-        def dactivation_dz(layer, activation_val):
-            if self.activation_functions[layer] == "tanh":
-                return 1 - np.tanh(activation_val) ** 2
-            elif self.activation_functions[layer] == "relu":
-                dactivation = activation_val.copy()
-                dactivation[dactivation <= 0] = 0
-                dactivation[dactivation > 0] = 1
-                return dactivation
-            else:
-                return np.ones(activation_val.shape)
+        # labels - 1-hot matrix (classes, batch) or 0 based class indices (batch,)
+        labels = np.asarray(labels)
+        batch_size = np.size(labels, -1)
+
+        # softmax cross entropy gradient, 1 is subtracted at the true class of each example
+        output_delta = self.output_delta if self.output_delta.shape == net_out.shape else np.empty(net_out.shape, dtype=self.dtype)
+        np.copyto(output_delta, net_out)
+        if labels.ndim == 1:
+            output_delta[..., labels, np.arange(batch_size)] -= 1
+        else:
+            output_delta -= labels.astype(self.dtype, copy=False)
 
-        batch_size = np.size(labels, 1)
         # for each example in the batch sum gradients on all layers
         dL_da = [0] * (len(self.layers) - 1)
         for layer in range(len(self.layers) - 2, -1, -1):
             # delta = dL/da * da/dz
             if layer == len(self.layers) - 2:
-                delta = (net_out - labels).transpose()
+                delta = output_delta.swapaxes(-1, -2)
             else:
-                delta = dL_da[layer + 1] * (dactivation_dz(layer, self.activations[layer + 1][1:, :]).transpose())
+                # activation derivative from the state cached by the forward pass, applied in place
+                delta = dL_da[layer + 1]
+                cache = self.caches[layer]
+                self.activation_kernels[layer].backward(delta, None if cache is None else cache.swapaxes(-1, -2))
             prev_act = self.activations[layer]  # get activation of the prev layer
-            self.grads[layer] = np.dot(prev_act, delta)  # dL/dw = (a_m - T)*a_m-1^T
-            dL_da[layer] = np.dot(delta, self.weights[layer][1:, :].transpose())  # dL/d(a_m-1) = w_m^T*(a_m - T)
-            dL_da[layer] *= (self.mask[layer]).transpose()
-
-        # add regularization to gradient and average loss on batch
+            np.matmul(prev_act, delta, out=self.grads[layer])  # dL/dw = (a_m - T)*a_m-1^T
+            if layer == 0:
+                break  # nothing uses the gradient of the input
+            dL_da[layer] = np.matmul(delta, self.compute_weights[layer][..., 1:, :].swapaxes(-1, -2))  # dL/d(a_m-1) = w_m^T*(a_m - T)
+            if np.any(self.dropout[layer] > 0):
+                dL_da[layer] *= self.mask[layer].swapaxes(-1, -2)
+
+        # add regularization to gradient and average loss on batch, in place
+        if self.optimizer.reg_in_loss and self.reg_grads is None:
+            self.reg_grads = [np.empty(shape, dtype=self.dtype) for shape in self.param_shapes()]
         for layer in range(len(self.layers) - 2, -1, -1):
             # average gradients
-            self.grads[layer] = self.grads[layer] / batch_size
+            self.grads[layer] /= batch_size
 
             # in SGD the loss has L2 regularization
-            if self.optimizer == "SGD":
+            if self.optimizer.reg_in_loss:
+                # add regularization, in the compute dtype also for the per model reg of a stack
+                reg, dreg = np.asarray(self.reg, dtype=self.dtype), self.reg_grads[layer]
                 if self.reg_type == "L2":
-                    dreg = self.weights[layer]
+                    np.multiply(reg, self.compute_weights[layer], out=dreg)
                 elif self.reg_type == "L1":
-                    dreg = self.weights[layer].copy()
-                    dreg[dreg < 0] = -1.0
-                    dreg[dreg > 0] = 1.0
-
-                # add regularization
-                self.grads[layer] += self.reg*dreg
+                    np.sign(self.compute_weights[layer], out=dreg)
+                    dreg *= reg
+                self.grads[layer] += dreg
 
     # return the sum of losses per batch
     def loss_function(self, batched_data, net_out, labels):
+        return self.data_loss(labels) + self.reg_loss()
+
+    def data_loss(self, labels):
+        # numerically stable log likelihood calculation, summed on the examples
+        # labels - 1-hot matrix (classes, batch) or 0 based class indices (batch,)
+        # the log-sum-exp is the one the softmax of the forward pass computed
+        # a stack returns the (K,) losses of its models
+        labels = np.asarray(labels)
+        if labels.ndim == 1:
+            label_exit = self.logits[..., labels, np.arange(labels.size)]  # get the value at the true exit
+        else:
+            label_exit = np.sum(self.logits * labels.astype(self.dtype, copy=False), axis=-2)
+        return np.sum(self.log_norm, axis=(-2, -1)) - np.sum(label_exit, axis=-1)
+
+    def reg_loss(self):
         sum_weights = 0.0
-        if self.optimizer == "SGD":
+        if self.optimizer.reg_in_loss:
             for l in range(len(self.layers) - 1):
                 # L2 regularization proportional to the loss value
-                reg_term = (1/2) * np.sum(self.weights[l] ** 2) if self.reg_type == "L2" else np.sum(np.abs(self.weights[l]))
+                reg_term = (1/2) * np.sum(self.weights[l] ** 2, axis=(-2, -1), keepdims=True) if self.reg_type == "L2" else np.sum(np.abs(self.weights[l]), axis=(-2, -1), keepdims=True)
                 sum_weights += reg_term
-
-        # numerically stable log likelihood calculation
-        label_exit = np.sum(self.logits * labels, axis=0)  # get the value at the true exit
-        e_x = np.exp(self.logits)
-        loss = -(label_exit - np.log(np.sum(e_x, axis=0)))
-
-        sum_loss = np.sum(loss) + self.reg*sum_weights
-        return sum_loss
+        return np.reshape(self.reg*sum_weights, self.stack_shape)  # per model terms of a stack
 
     def test_time(self):
         self.is_train = False
@@ -142,28 +225,36 @@ class Fully_Connected:
         self.is_train = True
 
     def init_vals(self, init_grads=False):
-        self.activations = []
-        self.mask = []
+        # activation, mask and gradient buffers are reused, they are overwritten by the next forward and backward passes
         self.logits = 0
         if init_grads:
-            self.grads = [np.zeros((prev_layer + 1, next_layer)) for prev_layer, next_layer in zip(self.layers, self.layers[1:])]
+            for grads in self.grads:
+                grads.fill(0)
 
     def step(self):
         self.update_counter += 1  # count time steps
-        for layer_num in range(len(self.layers) - 1):
-            # Nesterov gradient calculation
-            if self.optimizer == "SGD":
-                prev_accum_grads = self.accum_grads[layer_num].copy()
-                self.accum_grads[layer_num] = self.momentum * self.accum_grads[layer_num] - self.lr * self.grads[layer_num]
-                self.weights[layer_num] = self.weights[layer_num] - self.momentum * prev_accum_grads + (1 + self.momentum) * self.accum_grads[layer_num]
-
-            # ADAM optimizer with weight decay
-            else:
-                self.accum_grads[layer_num] = self.momentum * self.accum_grads[layer_num] + (1 - self.momentum) * self.grads[layer_num]
-                self.sec_accum_grads[layer_num] = self.second_moment * self.sec_accum_grads[layer_num] + (1 - self.second_moment) * (self.grads[layer_num] ** 2)
-                m_hat = self.accum_grads[layer_num] / (1 - (self.momentum ** self.update_counter))  # bias corrected first moment
-                v_hat = self.sec_accum_grads[layer_num] / (1 - (self.second_moment ** self.update_counter))  # bias corrected second moment
-                self.weights[layer_num] = self.weights[layer_num] - self.lr * m_hat / (np.sqrt(v_hat) + EPSILON) - self.reg * self.weights[layer_num]
+        with self.profiler.section("optimizer_step"):
+            self.optimizer.step(self)  # update weights and moments in place
+            if self.masks is not None:
+                self.apply_masks()
+            self.sync_weights()
+
+    def set_masks(self, masks):
+        # masks - boolean arrays shaped like the weights, False is pruned, None trains every weight again
+        self.masks = masks
+        if masks is not None:
+            self.apply_masks()
+            self.sync_weights()
+
+    def apply_masks(self):
+        for weights, mask in zip(self.weights, self.masks):
+            np.multiply(weights, mask, out=weights)
+
+    def sync_weights(self):
+        # refresh the compute copy of the weights from the master weights
+        if self.compute_weights is not self.weights:
+            for layer_num in range(len(self.layers) - 1):
+                np.copyto(self.compute_weights[layer_num], self.weights[layer_num], casting='same_kind')
 
     def get_grads(self):
         return self.grads.copy()
@@ -173,32 +264,69 @@ class Fully_Connected:
 
     def set_param(self, layer, src_neuron, dst_neuron, val):
         self.weights[layer][src_neuron, dst_neuron] = val
+        self.sync_weights()
 
     def decay_lr(self):
         self.epoch = self.epoch + 1
-        if self.optimizer == "SGD":
-            self.lr = max(MIN_LR, self.lr / LR_SCALE)  # cut by halve each time
-        else:  # In ADAM decay lr  and regularization at each epoch
-            self.lr = self.initial_lr / np.sqrt(self.epoch)
-            self.reg = self.initilal_reg / np.sqrt(self.epoch)
+        self.optimizer.decay_lr(self)
 
     def momentum_change(self):
         self.momentum = min(MAX_MOMENTUM, self.momentum + MOMENTUM_SCALE)  # change momentum
 
     def weights_norm(self):
-        # calc norm of each matrix and max eigenvalue
-        for layer_num in range(len(self.layers) - 1):
-            dot_product = np.dot(self.weights[layer_num], self.weights[layer_num].transpose())
-            norm = np.linalg.norm(dot_product)
-            max_eigenval = np.max(np.linalg.eig(dot_product)[0])
-            norm_eig = np.asarray([int(layer_num + 1), float(norm), max_eigenval.real]).reshape(1, -1)
-            net_norm = norm_eig.copy() if layer_num == 0 else np.concatenate((net_norm, norm_eig.copy()), axis=0)
-        net_norm = np.concatenate((net_norm, np.zeros(3).reshape(1, -1)))  # add delimiter between epochs
-        return net_norm
+        # calc frobenius norm of each matrix and max eigenvalue of W W^T (squared largest singular value)
+        # a stack has the rows of each of its models, each followed by a delimiter
+        net_norm = []
+        n_layers = len(self.layers) - 1
+        for member_num, member in enumerate(np.ndindex(self.stack_shape)):
+            for layer_num in range(n_layers):
+                weights = self.weights[layer_num][member]
+                vec_num = member_num * n_layers + layer_num  # norm vectors are member major
+                eigenval, self.norm_vectors[vec_num] = max_eigenval(weights, self.norm_vectors[vec_num], layer_num)
+                net_norm.append([layer_num + 1, np.linalg.norm(weights), eigenval])
+            net_norm.append([0, 0, 0])  # add delimiter between epochs
+        return np.asarray(net_norm, dtype=np.float64)
 
     def init_weights(self, weights, accum_grads, sec_accum_grads):
         # copy weights learned by AE aside from the last layer
-        for layer_num in range(len(self.layers) - 1):
-            self.weights[layer_num] = weights[layer_num].copy()
-            self.accum_grads[layer_num] = accum_grads[layer_num].copy()
-            self.sec_accum_grads[layer_num] = sec_accum_grads[layer_num].copy()
+        # the arrays of a single model are copied to every model of a stack
+        for layer_num, shape in enumerate(self.param_shapes()):
+            self.weights[layer_num] = np.broadcast_to(weights[layer_num], shape).astype(self.master_dtype)
+            if accum_grads is not None:  # moments are not stored in inference only checkpoints
+                self.accum_grads[layer_num] = np.broadcast_to(accum_grads[layer_num], shape).astype(self.master_dtype)
+                self.sec_accum_grads[layer_num] = np.broadcast_to(sec_accum_grads[layer_num], shape).astype(self.master_dtype)
+        self.sync_weights()
+
+
+class Stacked_Fully_Connected(Fully_Connected):
+    # K models of the same topology trained on the same batches, each array has a leading model axis
+    # the Fully_Connected passes run one batched matmul for all models, lr, reg_lambda and dropout can differ per model
+    # losses and accuracies are (K,) arrays, the output is (K, classes, batch)
+
+    def __init__(self, nn_params):
+        self.n_models = nn_params["models"]
+        self.stack_shape = (self.n_models,)
+        self.variants = nn_params["model_variants"] or [{}] * self.n_models  # per model overrides of nn_params
+        if len(self.variants) != self.n_models:
+            raise ValueError("{0} model variants for {1} models".format(len(self.variants), self.n_models))
+        super().__init__(nn_params)
+
+        # per model hyper parameters broadcast on the (K, rows, cols) arrays
+        self.initial_lr = self.lr = self.per_model(nn_params, "lr")
+        self.initilal_reg = self.reg = self.per_model(nn_params, "reg_lambda")
+        dropout = [self.member_params(nn_params, member)["dropout"] for member in range(self.n_models)]
+        self.dropout = [np.asarray(layer_dropout, dtype=self.dtype).reshape(self.n_models, 1, 1) for layer_dropout in zip(*dropout)]
+
+    def member_params(self, nn_params, member):
+        # nn_params of a single model of the stack
+        params = dict(nn_params, models=1, model_variants=None, ensemble=False)
+        params.update(self.variants[member])
+        return params
+
+    def per_model(self, nn_params, key):
+        return np.asarray([self.member_params(nn_params, member)[key] for member in range(self.n_models)], dtype=self.master_dtype).reshape(self.n_models, 1, 1)
+
+
+def build(nn_params):
+    # a stack when more than one model is trained
+    return Stacked_Fully_Connected(nn_params) if nn_params["models"] > 1 else Fully_Connected(nn_params)
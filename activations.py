@@ -0,0 +1,140 @@
+import numpy as np
+
+LEAKY_SLOPE = 0.01  # slope of leaky relu for negative inputs
+GELU_SCALE = float(np.sqrt(2 / np.pi))  # constants of the tanh approximation of gelu
+GELU_CUBIC = 0.044715
+
+
+class Activation:
+    # forward(z, out, cache) writes the activation of z to out, z may be overwritten
+    # when a cache buffer is given forward keeps what backward needs in it, so backward never recomputes the activation
+    cached = False  # backward needs a (units, batch) cache filled by forward
+    cache_dtype = None  # dtype of the cache buffer, None is the compute dtype
+
+    def new_cache(self, units, batch_size, dtype, stack=()):
+        if not self.cached:
+            return None
+        return np.empty(stack + (units, batch_size), dtype=self.cache_dtype or dtype)
+
+    def forward(self, z, out, cache=None):
+        raise NotImplementedError
+
+    def backward(self, grad, cache):
+        # multiply grad by da/dz in place
+        pass
+
+
+class Linear(Activation):
+
+    def forward(self, z, out, cache=None):
+        if out is not z:
+            out[...] = z
+        return out
+
+
+class ReLU(Activation):
+    cached = True
+    cache_dtype = np.bool_  # z > 0
+
+    def forward(self, z, out, cache=None):
+        if cache is not None:
+            np.greater(z, 0, out=cache)
+        return np.maximum(z, 0, out=out)  # a = relu(z, 0)
+
+    def backward(self, grad, cache):
+        np.multiply(grad, cache, out=grad)
+
+
+class LeakyReLU(Activation):
+    cached = True
+    cache_dtype = np.bool_  # z > 0
+
+    def forward(self, z, out, cache=None):
+        positive = np.greater(z, 0, out=cache)
+        np.multiply(z, LEAKY_SLOPE, out=out, where=~positive)
+        if out is not z:
+            np.copyto(out, z, where=positive)
+        return out
+
+    def backward(self, grad, cache):
+        np.multiply(grad, LEAKY_SLOPE, out=grad, where=~cache)
+
+
+class Tanh(Activation):
+    cached = True  # 1 - a ** 2
+
+    def forward(self, z, out, cache=None):
+        np.tanh(z, out=out)  # a = tanh(z)
+        if cache is not None:
+            np.multiply(out, out, out=cache)
+            np.subtract(1, cache, out=cache)
+        return out
+
+    def backward(self, grad, cache):
+        np.multiply(grad, cache, out=grad)
+
+
+class Sigmoid(Activation):
+    cached = True  # a * (1 - a)
+
+    def forward(self, z, out, cache=None):
+        np.negative(z, out=out)
+        np.exp(out, out=out)
+        out += 1
+        np.reciprocal(out, out=out)  # a = 1 / (1 + exp(-z))
+        if cache is not None:
+            np.subtract(1, out, out=cache)
+            cache *= out
+        return out
+
+    def backward(self, grad, cache):
+        np.multiply(grad, cache, out=grad)
+
+
+class GELU(Activation):
+    # tanh approximation, a = z / 2 * (1 + tanh(s * (z + c * z ** 3)))
+    cached = True  # da/dz
+
+    def forward(self, z, out, cache=None):
+        inner = GELU_SCALE * (z + GELU_CUBIC * z ** 3)
+        tanh_inner = np.tanh(inner, out=inner)
+        if cache is not None:
+            # da/dz = (1 + t) / 2 + z / 2 * (1 - t ** 2) * s * (1 + 3 * c * z ** 2)
+            np.multiply(z, z, out=cache)
+            cache *= 3 * GELU_CUBIC
+            cache += 1
+            cache *= GELU_SCALE * 0.5 * z * (1 - tanh_inner ** 2)
+            cache += 0.5 * (1 + tanh_inner)
+        tanh_inner += 1
+        np.multiply(z, tanh_inner, out=out)
+        out *= 0.5
+        return out
+
+    def backward(self, grad, cache):
+        np.multiply(grad, cache, out=grad)
+
+
+class Softmax(Activation):
+    # output layer only, its gradient is combined with the cross entropy loss in Fully_Connected.backward
+    # the cache is the log of the normalizer of the shifted z, reused by the loss
+    cached = True
+
+    def new_cache(self, units, batch_size, dtype, stack=()):
+        return np.empty(stack + (1, batch_size), dtype=dtype)
+
+    def forward(self, z, out, cache=None):
+        # classes are on the second to last axis
+        z -= np.max(z, axis=-2, keepdims=True)  # subtract the max valued class of each example to prevent overflow
+        np.exp(z, out=out)
+        norm = np.sum(out, axis=-2, keepdims=True)
+        out /= norm
+        if cache is not None:
+            np.log(norm, out=cache)
+        return out
+
+
+ACTIVATIONS = {"linear": Linear, "relu": ReLU, "leaky_relu": LeakyReLU, "tanh": Tanh, "sigmoid": Sigmoid, "gelu": GELU, "softmax": Softmax}
+
+
+def get_activation(name):
+    return ACTIVATIONS[name.lower()]()
@@ -0,0 +1,131 @@
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+import Network
+import logger
+import main
+
+# sweep of the benchmark, the first layers config is the main.py topology
+LAYERS = [main.nn_params["layers"], [3072, 1000, 10]]
+BATCH_SIZES = [32, 128]
+OPTIMIZERS = ["SGD", "ADAM"]
+DROPOUT = [False, True]
+DTYPES = ["float64", "float32"]
+
+WARMUP_STEPS = 3
+STEPS = 20
+MEMORY_STEPS = 2  # steps traced for peak memory, not timed
+REGRESSION_THRESHOLD = 0.1  # fraction of throughput lost before a config is reported as a regression
+OPS = ["forward", "loss", "backward", "step"]
+
+
+def config_name(config):
+    return "{0} batch={1} {2} dropout={3} {4}".format("-".join(map(str, config["layers"])), config["batch_size"], config["optimizer"], config["dropout"], config["dtype"])
+
+
+def make_params(config):
+    nn_params = dict(main.nn_params)
+    nn_params["layers"] = config["layers"]
+    nn_params["activations"] = ["relu"] * (len(config["layers"]) - 2) + ["softmax"]
+    nn_params["dropout"] = [0.2 if config["dropout"] else 0.0] * (len(config["layers"]) - 1)
+    nn_params["optimizer"] = config["optimizer"]
+    nn_params["second_moment"] = 0.999 if config["optimizer"] == "ADAM" else 0.0
+    nn_params["dtype"] = config["dtype"]
+    return nn_params
+
+
+def train_step(model, x, labels, timings=None):
+    model.train_time()
+    model.init_vals(True)
+    start = time.perf_counter()
+    out = model.forward(x)
+    forward_end = time.perf_counter()
+    model.loss_function(x, out, labels)
+    loss_end = time.perf_counter()
+    model.backward(x, out, labels)
+    backward_end = time.perf_counter()
+    model.step()
+    step_end = time.perf_counter()
+    if timings is not None:
+        timings["forward"].append(forward_end - start)
+        timings["loss"].append(loss_end - forward_end)
+        timings["backward"].append(backward_end - loss_end)
+        timings["step"].append(step_end - backward_end)
+
+
+def run_config(config):
+    # synthetic batches, the same few batches are reused on every step
+    np.random.seed(0)
+    layers = config["layers"]
+    batches = []
+    for _ in range(4):
+        x = np.random.randn(layers[0], config["batch_size"]).astype(config["dtype"])
+        labels = np.random.randint(layers[-1], size=config["batch_size"])
+        batches.append((x, labels))
+
+    # peak traced memory of building the model and a few steps
+    tracemalloc.start()
+    model = Network.Fully_Connected(make_params(config))
+    for step_num in range(MEMORY_STEPS):
+        train_step(model, *batches[step_num % len(batches)])
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    for step_num in range(WARMUP_STEPS):
+        train_step(model, *batches[step_num % len(batches)])
+
+    timings = {op: [] for op in OPS}
+    start = time.perf_counter()
+    for step_num in range(STEPS):
+        train_step(model, *batches[step_num % len(batches)], timings)
+    elapsed = time.perf_counter() - start
+
+    result = dict(config)
+    result["name"] = config_name(config)
+    result["examples_per_sec"] = STEPS * config["batch_size"] / elapsed
+    result["latency_ms"] = {op: {"p50": 1000 * np.percentile(timings[op], 50), "p90": 1000 * np.percentile(timings[op], 90), "p99": 1000 * np.percentile(timings[op], 99)} for op in OPS}
+    result["peak_memory_mb"] = peak_memory / 2 ** 20
+    return result
+
+
+def compare(results, baseline, log, threshold=REGRESSION_THRESHOLD):
+    # returns the names of the configs whose throughput dropped by more than threshold
+    baseline = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        if result["name"] not in baseline:
+            continue
+        ratio = result["examples_per_sec"] / baseline[result["name"]]["examples_per_sec"]
+        regressed = ratio < 1 - threshold
+        if regressed:
+            regressions.append(result["name"])
+        log.log("{0:<50}{1:>8.2f}x {2}".format(result["name"], ratio, "REGRESSION" if regressed else ""))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    # benchmark.py <results .json> [<baseline .json>], exits with 1 when a config regressed against the baseline
+    results_path = sys.argv[1]
+    baseline_path = sys.argv[2] if len(sys.argv) > 2 else None
+    log = logger.LOGGER()
+
+    results = []
+    for layers, batch_size, optimizer, dropout, dtype in itertools.product(LAYERS, BATCH_SIZES, OPTIMIZERS, DROPOUT, DTYPES):
+        config = {"layers": layers, "batch_size": batch_size, "optimizer": optimizer, "dropout": dropout, "dtype": dtype}
+        result = run_config(config)
+        results.append(result)
+        latency = result["latency_ms"]
+        log.log("{0:<50}{1:>10.1f} ex/s  fwd {2:.2f}ms  bwd {3:.2f}ms  step {4:.2f}ms  peak {5:.1f}MB".format(
+            result["name"], result["examples_per_sec"], latency["forward"]["p50"], latency["backward"]["p50"], latency["step"]["p50"], result["peak_memory_mb"]))
+
+    with open(results_path, 'w') as f:
+        json.dump({"numpy": np.__version__, "results": results}, f, indent=2)
+
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), log)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+import Network
+
+# version of the checkpoint layout, bumped on incompatible changes
+FORMAT_VERSION = 1
+COUNTERS = ["update_counter", "epoch", "lr", "reg", "momentum"]
+
+
+def csr_arrays(key, matrix):
+    # compressed sparse rows of a matrix, the nonzero values, their columns and the offset of each row in them
+    rows, cols = np.nonzero(matrix)
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=matrix.shape[0]), out=indptr[1:])
+    return {key + "_data": matrix[rows, cols], key + "_indices": cols.astype(np.int32), key + "_indptr": indptr, key + "_shape": np.asarray(matrix.shape)}
+
+
+def read_matrix(data, key):
+    # a dense matrix, stored as is or as the arrays of csr_arrays
+    if key in data.files:
+        return data[key]
+    shape, indptr = tuple(data[key + "_shape"]), data[key + "_indptr"]
+    values = data[key + "_data"]
+    matrix = np.zeros(shape, dtype=values.dtype)
+    matrix[np.repeat(np.arange(shape[0]), np.diff(indptr)), data[key + "_indices"]] = values
+    return matrix
+
+
+def snapshot(model, nn_params, moments=True, scaling=None, member=None, sparse=False):
+    # copies of the arrays of a checkpoint, training can go on while they are written
+    # scaling - (mean, std) z score scaling of the inputs, stored so inference reproduces the preprocessing
+    # member - model of a stack saved as a single model checkpoint, nn_params are the ones of the member
+    # sparse - pruned weights stored as csr arrays and no pruning masks, a smaller file of a pruned model for inference
+    arrays = {"format_version": np.asarray(FORMAT_VERSION), "nn_params": np.asarray(json.dumps(nn_params))}
+    if scaling is not None:
+        arrays["scaling_mean"], arrays["scaling_std"] = np.array(scaling[0]), np.array(scaling[1])
+    for counter in COUNTERS:
+        arrays[counter] = np.asarray(getattr(model, counter))
+        if member is not None and arrays[counter].ndim:
+            arrays[counter] = arrays[counter].reshape(-1)[member]  # per model counters of a stack
+    select = (lambda array: array) if member is None else (lambda array: array[member])
+    for layer_num in range(len(model.layers) - 1):
+        weights = select(model.weights[layer_num])
+        if sparse and np.count_nonzero(weights) * (weights.itemsize + 4) < weights.nbytes:  # csr only when it is smaller
+            arrays.update(csr_arrays("weights_" + str(layer_num), weights))
+        else:
+            arrays["weights_" + str(layer_num)] = weights.copy()
+        if model.masks is not None and not sparse:
+            arrays["masks_" + str(layer_num)] = select(np.broadcast_to(model.masks[layer_num], model.weights[layer_num].shape)).copy()
+        if moments:
+            arrays["accum_grads_" + str(layer_num)] = select(model.accum_grads[layer_num]).copy()
+            arrays["sec_accum_grads_" + str(layer_num)] = select(model.sec_accum_grads[layer_num]).copy()
+    return arrays
+
+
+def state_snapshot(model, nn_params, train_state, scaling=None):
+    # full training state, the checkpoint arrays with the random streams, the norm estimates and the train loop state
+    arrays = snapshot(model, nn_params, scaling=scaling)
+    arrays["rng_state"] = np.asarray(json.dumps(model.rng.bit_generator.state))
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    arrays["np_random_keys"] = keys.copy()
+    arrays["np_random_state"] = np.asarray([pos, has_gauss, cached_gaussian], dtype=np.float64)
+    for layer_num, vecs in enumerate(model.norm_vectors):
+        if vecs is not None:
+            arrays["norm_vectors_" + str(layer_num)] = vecs.copy()
+    for key, val in train_state.items():
+        arrays["train_" + key] = np.array(val)
+    return arrays
+
+
+def write(arrays, path):
+    # write to a temporary file and rename it so a crash never leaves a partial checkpoint
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def save(model, path, nn_params, moments=True, scaling=None, sparse=False):
+    # weights, optimizer moments, counters, hyper-parameters and input scaling in a single .npz, loadable without pickle
+    write(snapshot(model, nn_params, moments, scaling, sparse=sparse), path)
+
+
+def read(path, moments=True):
+    # returns the stored arrays, moments are None when they were not saved or not requested
+    with np.load(path, allow_pickle=False) as data:
+        version = int(data["format_version"])
+        if version > FORMAT_VERSION:
+            raise ValueError("checkpoint format version {0} is newer than the supported version {1}".format(version, FORMAT_VERSION))
+
+        nn_params = json.loads(str(data["nn_params"]))
+        n_layers = len(nn_params["layers"]) - 1
+        ckpt = {"nn_params": nn_params, "weights": [read_matrix(data, "weights_" + str(layer_num)) for layer_num in range(n_layers)]}
+        ckpt["masks"] = [data["masks_" + str(layer_num)] for layer_num in range(n_layers)] if "masks_0" in data.files else None
+        for counter in COUNTERS:
+            ckpt[counter] = data[counter] if data[counter].ndim else data[counter].item()  # arrays are per model counters of a stack
+
+        has_moments = moments and "accum_grads_0" in data.files
+        ckpt["accum_grads"] = [data["accum_grads_" + str(layer_num)] for layer_num in range(n_layers)] if has_moments else None
+        ckpt["sec_accum_grads"] = [data["sec_accum_grads_" + str(layer_num)] for layer_num in range(n_layers)] if has_moments else None
+        ckpt["mean"] = data["scaling_mean"] if "scaling_mean" in data.files else None
+        ckpt["std"] = data["scaling_std"] if "scaling_std" in data.files else None
+
+        # training state of full state checkpoints
+        if "rng_state" in data.files:
+            ckpt["rng_state"] = json.loads(str(data["rng_state"]))
+            pos, has_gauss, cached_gaussian = data["np_random_state"]
+            ckpt["np_random_state"] = ("MT19937", data["np_random_keys"], int(pos), int(has_gauss), float(cached_gaussian))
+            n_vectors = n_layers * nn_params.get("models", 1)  # checkpoints older than stacks have no models key
+            ckpt["norm_vectors"] = [data["norm_vectors_" + str(vec_num)] if "norm_vectors_" + str(vec_num) in data.files else None for vec_num in range(n_vectors)]
+            ckpt["train_state"] = {key[len("train_"):]: data[key] if data[key].ndim else data[key].item() for key in data.files if key.startswith("train_")}
+    return ckpt
+
+
+def restore(model, ckpt, counters=True):
+    model.init_weights(ckpt["weights"], ckpt["accum_grads"], ckpt["sec_accum_grads"])
+    if ckpt["masks"] is not None:
+        model.set_masks(ckpt["masks"])
+    if counters:
+        for counter in COUNTERS:
+            setattr(model, counter, ckpt[counter])
+
+
+def restore_training(model, ckpt):
+    # continue the random streams and the norm estimates of a full state checkpoint, returns the train loop state
+    model.rng.bit_generator.state = ckpt["rng_state"]
+    model.norm_vectors = list(ckpt["norm_vectors"])
+    np.random.set_state(ckpt["np_random_state"])
+    return ckpt["train_state"]
+
+
+def load(path, moments=True):
+    # build a model with the stored hyper-parameters and state
+    ckpt = read(path, moments)
+    model = Network.build(dict({"models": 1}, **ckpt["nn_params"]))
+    restore(model, ckpt)
+    return model
@@ -1,7 +1,9 @@
+import os
 import numpy as np
 import pickle
 import matplotlib.pyplot as plt
 import Network
+import data_loader
 
 np.random.seed(111)
 
@@ -13,6 +15,11 @@ nb_classes = 10
 img_size_flat = img_size * img_size * img_channels
 nb_files_train = 5
 images_per_file = 10000
+luma_weights = (.3, .59, .11)  # weights of the red, green and blue channels in grayscale
+
+# binary cache written next to the batches, keyed by the path, size and modification time of each batch file
+CACHE_IMAGES_SUFFIX = ".uint8.images.npy"
+CACHE_LABELS_SUFFIX = ".labels.npy"
 
 
 def read_data(file):
@@ -29,6 +36,78 @@ def read_data(file):
     return images, labels
 
 
+def is_batch_path(path):
+    # a directory of data_batch_* files or a single pickled batch
+    return os.path.isdir(path) or os.path.basename(path).startswith(("data_batch", "test_batch"))
+
+
+def batch_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, "data_batch_" + str(num)) for num in range(1, nb_files_train + 1)]
+    return [path]
+
+
+def load_batches(path, cache=True):
+    # all the batches of path in one contiguous uint8 array, examples in rows in the stored channel first layout
+    # labels are 1 based as in the csv files, with cache the array is written once and memory mapped on later runs
+    files = batch_files(path)
+    base = os.path.join(path, "data_batches") if os.path.isdir(path) else path
+    if cache:
+        prefix = data_loader.cache_prefix(base, files)
+        images_cache, labels_cache = prefix + CACHE_IMAGES_SUFFIX, prefix + CACHE_LABELS_SUFFIX
+        if os.path.exists(images_cache) and os.path.exists(labels_cache):
+            return np.load(images_cache, mmap_mode='r'), np.load(labels_cache)
+        data_loader.remove_stale_cache(base, prefix)
+
+    shape = (len(files) * images_per_file, img_size_flat)
+    if cache:
+        tmp_images_cache = images_cache + ".tmp.npy"
+        images = np.lib.format.open_memmap(tmp_images_cache, mode='w+', dtype=np.uint8, shape=shape)
+    else:
+        images = np.empty(shape, dtype=np.uint8)
+    labels = np.empty(shape[0], dtype=np.int64)
+    for file_num, file in enumerate(files):
+        with open(file, 'rb') as fo:
+            data = pickle.load(fo, encoding='bytes')
+        if len(data[b'labels']) != images_per_file:
+            raise ValueError("{0} holds {1} images, expected {2}".format(file, len(data[b'labels']), images_per_file))
+        rows = slice(file_num * images_per_file, (file_num + 1) * images_per_file)
+        images[rows] = data[b'data']
+        labels[rows] = np.asarray(data[b'labels']) + 1
+
+    if not cache:
+        return images, labels
+
+    # the labels are written first, both files must exist to use the cache
+    tmp_labels_cache = labels_cache + ".tmp.npy"
+    np.save(tmp_labels_cache, labels)
+    os.replace(tmp_labels_cache, labels_cache)
+    images.flush()
+    del images
+    os.replace(tmp_images_cache, images_cache)
+    return np.load(images_cache, mmap_mode='r'), labels
+
+
+class Decoder:
+    # converts gathered uint8 rows to float features in [0, 1], optionally grayscale, a mini-batch at a time
+
+    def __init__(self, grayscale=False, dtype=np.float32):
+        self.grayscale = grayscale
+        self.dtype = dtype
+        self.weights = np.asarray(luma_weights, dtype=dtype) / 255.0  # grayscale and scaling in one multiply per channel
+
+    def __call__(self, rows):
+        if not self.grayscale:
+            out = np.asarray(rows).astype(self.dtype)
+            out *= 1 / 255.0
+            return out
+        planes = np.asarray(rows).reshape(-1, img_channels, img_size * img_size)
+        out = np.multiply(planes[:, 0], self.weights[0], dtype=self.dtype)
+        for channel in range(1, img_channels):
+            out += planes[:, channel] * self.weights[channel]
+        return out
+
+
 def grayscale(data, dtype='float32'):
     # luma coding weighted average in video systems
     r, g, b = np.asarray([.3], dtype=dtype), np.asarray([.59], dtype=dtype), np.asarray([.11], dtype=dtype)
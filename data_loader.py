@@ -0,0 +1,273 @@
+import glob
+import hashlib
+import itertools
+import numpy as np
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import profiler
+
+STATS_CHUNK_ROWS = 4096  # rows read at once when computing feature statistics
+CSV_CHUNK_ROWS = 2048  # rows parsed at once when reading a csv file
+CACHE_IMAGES_SUFFIX = ".images.npy"
+CACHE_LABELS_SUFFIX = ".labels.npy"
+CACHE_FILE_PATTERN = re.compile(r"\.[0-9a-f]{16}(\.\w+)+\.npy")
+
+
+# transforms on a batch of images shaped (batch, channels, height, width)
+TRANSFORMS = {
+    "none": lambda imgs: imgs,
+    "fliplr": lambda imgs: imgs[:, :, :, ::-1],  # flip left to right
+    "flipud": lambda imgs: imgs[:, :, ::-1, :],  # flip up to down
+    "transpose": lambda imgs: imgs.transpose(0, 1, 3, 2),  # swap height and width
+}
+
+
+class Augmentation:
+
+    def __init__(self, transforms, img_shape):
+        # transforms - dictionary of transform name and the probability it is applied to an example
+        self.names = list(transforms.keys())
+        self.probs = np.asarray([transforms[name] for name in self.names], dtype=np.float64)
+        self.probs = self.probs / np.sum(self.probs)
+        self.img_shape = tuple(img_shape)
+
+    def apply(self, x, rng=np.random):
+        # draw a single transform for each example in the batch and apply it in place
+        imgs = x.reshape((-1,) + self.img_shape)
+        choice = rng.choice(len(self.names), size=imgs.shape[0], p=self.probs)
+        for transform_num, name in enumerate(self.names):
+            selected = choice == transform_num
+            if name != "none" and np.any(selected):
+                imgs[selected] = TRANSFORMS[name](imgs[selected])
+        return x
+
+    def expected(self, v):
+        # expectation of a per feature vector over the transforms, transforms only permute features
+        imgs = v.reshape((1,) + self.img_shape)
+        return sum(prob * TRANSFORMS[name](imgs).reshape(-1) for name, prob in zip(self.names, self.probs))
+
+    def mixture_stats(self, mean, var):
+        # per feature mean and variance over the transforms, law of total variance instead of E[x^2] - E[x]^2
+        mix_mean = self.expected(mean)
+        mix_var = np.zeros_like(var)
+        for name, prob in zip(self.names, self.probs):
+            transformed_mean = TRANSFORMS[name](mean.reshape((1,) + self.img_shape)).reshape(-1)
+            transformed_var = TRANSFORMS[name](var.reshape((1,) + self.img_shape)).reshape(-1)
+            mix_var += prob * (transformed_var + (transformed_mean - mix_mean) ** 2)
+        return mix_mean, mix_var
+
+
+class Dataset:
+
+    def __init__(self, images, labels=None, decode=None):
+        self.images = images  # examples in rows, usually a read only np.memmap
+        self.labels = labels  # integer labels or None for unlabeled data
+        self.decode = decode  # converts gathered rows to float features, None uses the stored values
+        self.order = None  # permutation of the examples, None keeps the stored order
+        self.augmentation = None  # transforms applied to each gathered batch
+        self.copies = 1  # number of times each example is visited in an epoch
+        self.mean = None  # z score scaling applied to each gathered batch
+        self.std = None
+
+    def __len__(self):
+        return self.images.shape[0] * self.copies
+
+    def shuffle(self):
+        # permute indices only, the examples stay where they are
+        if self.order is None:
+            self.order = np.arange(len(self))
+        np.random.shuffle(self.order)
+
+    def set_augmentation(self, augmentation, copies=1):
+        self.augmentation = augmentation
+        self.copies = copies
+        self.order = None if copies == 1 else np.arange(len(self))
+
+    def set_scaling(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def feature_stats(self):
+        # mean and std of each feature in a single pass, chunks are merged with the parallel welford update
+        count = 0
+        mean = 0.0
+        sq_dev = 0.0  # sum of squared deviations from the mean
+        for ind in range(0, self.images.shape[0], STATS_CHUNK_ROWS):
+            chunk = self.images[ind:ind + STATS_CHUNK_ROWS]
+            chunk = np.array(chunk if self.decode is None else self.decode(chunk), dtype=np.float64)  # a copy, centered in place
+            chunk_count = chunk.shape[0]
+            chunk_mean = np.mean(chunk, axis=0)
+            chunk -= chunk_mean
+            delta = chunk_mean - mean
+            total_count = count + chunk_count
+            mean += delta * (chunk_count / total_count)
+            sq_dev += np.einsum('ij,ij->j', chunk, chunk) + delta ** 2 * (count * chunk_count / total_count)
+            count = total_count
+        var = sq_dev / max(count, 1)
+
+        # statistics of the augmented distribution the model is trained on
+        if self.augmentation is not None:
+            mean, var = self.augmentation.mixture_stats(mean, var)
+        return mean, np.sqrt(var)
+
+    def batch(self, ind, batch_size, rng=np.random):
+        # gather a single mini-batch, examples in columns
+        if self.order is None:
+            x = self.images[ind:ind + batch_size]
+            x = np.array(x) if self.decode is None else self.decode(x)
+            labels = None if self.labels is None else self.labels[ind:ind + batch_size].copy()
+        else:
+            indices = np.sort(self.order[ind:ind + batch_size] % self.images.shape[0])  # sorted indices read the memmap sequentially
+            x = self.images[indices]
+            if self.decode is not None:
+                x = self.decode(x)
+            labels = None if self.labels is None else self.labels[indices]
+
+        if self.augmentation is not None:
+            x = self.augmentation.apply(x, rng)
+        if self.mean is not None:
+            x -= self.mean
+            x /= self.std
+        return x.transpose(), labels
+
+    def batches(self, batch_size):
+        for ind in range(0, len(self), batch_size):
+            yield self.batch(ind, batch_size)
+
+
+class Prefetcher:
+
+    def __init__(self, data, batch_size, n_workers=2, n_prefetch=4, prof=profiler.NULL):
+        self.data = data
+        self.batch_size = batch_size
+        self.n_workers = n_workers  # 0 prepares the batches on the calling thread
+        self.n_prefetch = n_prefetch  # max number of batches prepared ahead
+        self.wait_time = 0.0  # time the consumer was blocked on data in the last pass
+        self.profiler = prof
+
+    def __len__(self):
+        return len(self.data)
+
+    def prepare(self, ind, seed):
+        # gather the batch and its 0 based class indices, each batch has its own random stream
+        batched_data, labels = self.data.batch(ind, self.batch_size, np.random.RandomState(seed))
+        if labels is None:
+            return batched_data, None
+        return batched_data, labels - 1
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        starts = iter(range(0, len(self.data), self.batch_size))
+        # batch seeds come from their own stream so results do not depend on the number of workers
+        seeds = np.random.RandomState(np.random.randint(2 ** 31))
+        seed = lambda: seeds.randint(2 ** 31)
+
+        if self.n_workers == 0:
+            for ind in starts:
+                start_time = time.time()
+                with self.profiler.section("data"):
+                    batch = self.prepare(ind, seed())
+                self.wait_time += time.time() - start_time
+                yield batch
+            return
+
+        with ThreadPoolExecutor(self.n_workers) as pool:
+            pending = deque(pool.submit(self.prepare, ind, seed()) for ind in itertools.islice(starts, self.n_prefetch))
+            while pending:
+                start_time = time.time()
+                with self.profiler.section("data"):
+                    batch = pending.popleft().result()
+                self.wait_time += time.time() - start_time
+
+                # keep the queue full
+                ind = next(starts, None)
+                if ind is not None:
+                    pending.append(pool.submit(self.prepare, ind, seed()))
+                yield batch
+
+
+def cache_prefix(file, sources=None):
+    # sidecar cache files are keyed by the path, size and modification time of their sources, file itself by default
+    keys = []
+    for source in [file] if sources is None else sources:
+        stat = os.stat(source)
+        keys.append("{0}|{1}|{2}".format(os.path.abspath(source), stat.st_size, stat.st_mtime_ns))
+    return file + "." + hashlib.md5("|".join(keys).encode()).hexdigest()[:16]
+
+
+def remove_stale_cache(file, prefix):
+    # delete caches written for older versions of the same sources
+    for path in glob.glob(glob.escape(file) + ".*.npy"):
+        if not path.startswith(prefix + ".") and CACHE_FILE_PATTERN.fullmatch(path[len(file):]):
+            os.remove(path)
+
+
+def count_rows(file):
+    # count lines in binary blocks without decoding them
+    rows = 0
+    last_byte = b'\n'
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            rows += block.count(b'\n')
+            last_byte = block[-1:]
+    return rows if last_byte == b'\n' else rows + 1
+
+
+def parse_csv(file, images_cache, labels_cache):
+
+    n_rows = count_rows(file)
+    if n_rows == 0:
+        raise ValueError("empty csv file: {0}".format(file))
+    images = None
+    labels = np.zeros(n_rows, dtype=np.int64)
+    has_labels = True
+    tmp_images_cache = images_cache + ".tmp"
+
+    row = 0
+    with open(file) as csv_file:
+        while True:
+            lines = list(itertools.islice(csv_file, CSV_CHUNK_ROWS))
+            if not lines:
+                break
+
+            # the first column is the label, the rest of the row is the image
+            heads, tails = zip(*(line.split(',', 1) for line in lines))
+            chunk = np.fromstring(','.join(tails), dtype=np.float32, sep=',').reshape(len(lines), -1)
+
+            # parse straight into a preallocated float32 memmap
+            if images is None:
+                images = np.lib.format.open_memmap(tmp_images_cache, mode='w+', dtype=np.float32, shape=(n_rows, chunk.shape[1]))
+            images[row:row + len(lines)] = chunk
+
+            if has_labels:
+                try:
+                    labels[row:row + len(lines)] = np.array(heads).astype(np.int64)
+                except ValueError:  # unlabeled (test) file
+                    has_labels = False
+            row += len(lines)
+
+    # the labels are written first, load_csv only checks for the images cache
+    if has_labels:
+        tmp_labels_cache = labels_cache + ".tmp"
+        with open(tmp_labels_cache, 'wb') as f:
+            np.save(f, labels)
+        os.replace(tmp_labels_cache, labels_cache)
+    images.flush()
+    del images
+    os.replace(tmp_images_cache, images_cache)
+
+
+def load_csv(file):
+    # parse the csv file once and load it from the binary cache on later runs
+    prefix = cache_prefix(file)
+    images_cache, labels_cache = prefix + CACHE_IMAGES_SUFFIX, prefix + CACHE_LABELS_SUFFIX
+    if not os.path.exists(images_cache):
+        remove_stale_cache(file, prefix)
+        parse_csv(file, images_cache, labels_cache)
+
+    images = np.load(images_cache, mmap_mode='r')
+    labels = np.load(labels_cache) if os.path.exists(labels_cache) else None
+    return images, labels
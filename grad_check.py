@@ -0,0 +1,131 @@
+import numpy as np
+import sys
+import time
+import Network
+import logger
+
+EPS = 10 ** -5  # perturbation size of the central differences
+TOLERANCE = 10 ** -5  # max relative error of a layer
+N_SAMPLES = 32  # single parameters checked in each layer
+N_DIRECTIONS = 2  # random directions checked in each layer
+BATCH_SIZE = 16
+
+
+def layer_inputs(model, x):
+    # input of each layer, with the bias row, without dropout
+    batch_size = x.shape[1]
+    acts = []
+    act = x
+    for layer_num in range(len(model.layers) - 1):
+        act = np.concatenate((np.ones((1, batch_size), dtype=act.dtype), act), axis=0)
+        acts.append(act)
+        z = np.dot(model.compute_weights[layer_num].transpose(), act)
+        act = model.activation_kernels[layer_num].forward(z, z)
+    return acts
+
+
+def stacked_data_loss(model, layer_num, z, labels):
+    # z - (perturbations, units, batch) pre-activations of layer_num, returns the data loss of each perturbation
+    for layer in range(layer_num, len(model.layers) - 1):
+        if layer > layer_num:
+            bias = np.ones((z.shape[0], 1, z.shape[2]), dtype=z.dtype)
+            z = np.matmul(model.compute_weights[layer].transpose(), np.concatenate((bias, act), axis=1))
+        if layer < len(model.layers) - 2:
+            act = model.activation_kernels[layer].forward(z, z)
+
+    # log likelihood of the last layer, as in Fully_Connected.data_loss, labels are 0 based class indices
+    logits = z - np.max(z, axis=1, keepdims=True)
+    label_exit = logits[:, labels, np.arange(labels.size)]
+    loss = -(label_exit - np.log(np.sum(np.exp(logits), axis=1)))
+    return np.sum(loss, axis=1)
+
+
+def reg_term(model, weights):
+    # regularization term of a single layer (or of stacked layers), as in Fully_Connected.reg_loss
+    if not model.optimizer.reg_in_loss:
+        return 0.0
+    if model.reg_type == "L2":
+        return model.reg * (1/2) * np.sum(weights ** 2, axis=(-2, -1))
+    return model.reg * np.sum(np.abs(weights), axis=(-2, -1))
+
+
+def check(model, x, labels, n_samples=N_SAMPLES, n_directions=N_DIRECTIONS, eps=EPS, seed=0):
+    # compare the gradients of backward with central differences of the loss averaged on the batch
+    # returns the relative error of each layer, use a float64 model to get meaningful errors
+    rng = np.random.default_rng(seed)
+    batch_size = x.shape[1]
+    x = x.astype(model.dtype)
+    labels = np.asarray(labels)
+
+    # analytic gradients without dropout
+    dropout, is_train = model.dropout, model.is_train
+    model.dropout = [0.0] * len(dropout)
+    model.train_time()
+    model.init_vals(True)
+    out = model.forward(x)
+    model.backward(x, out, labels)
+    grads = [grads.copy() for grads in model.grads]
+    model.dropout, model.is_train = dropout, is_train
+
+    acts = layer_inputs(model, x)
+    errors = []
+    for layer_num in range(len(model.layers) - 1):
+        weights = model.compute_weights[layer_num]
+        act = acts[layer_num]
+        z = np.dot(weights.transpose(), act)
+        numeric, analytic = [], []
+
+        # single parameters, each perturbation changes a single row of z
+        rows = rng.integers(weights.shape[0], size=n_samples)
+        cols = rng.integers(weights.shape[1], size=n_samples)
+        stacked = np.repeat(z[np.newaxis], 2 * n_samples, axis=0)
+        stacked[np.arange(n_samples), cols, :] += eps * act[rows, :]
+        stacked[n_samples + np.arange(n_samples), cols, :] -= eps * act[rows, :]
+        losses = stacked_data_loss(model, layer_num, stacked, labels) / batch_size
+        params = weights[rows, cols]
+        reg_diff = reg_term(model, (params + eps).reshape(-1, 1, 1)) - reg_term(model, (params - eps).reshape(-1, 1, 1))
+        numeric.append((losses[:n_samples] - losses[n_samples:] + reg_diff) / (2 * eps))
+        analytic.append(grads[layer_num][rows, cols])
+
+        # random unit directions, projection of the gradient on each direction
+        for _ in range(n_directions):
+            direction = rng.standard_normal(weights.shape).astype(weights.dtype)
+            direction /= np.linalg.norm(direction)
+            dz = np.dot(direction.transpose(), act)
+            losses = stacked_data_loss(model, layer_num, np.stack((z + eps * dz, z - eps * dz)), labels) / batch_size
+            reg_diff = reg_term(model, weights + eps * direction) - reg_term(model, weights - eps * direction)
+            numeric.append(np.asarray([(losses[0] - losses[1] + reg_diff) / (2 * eps)]))
+            analytic.append(np.asarray([np.sum(grads[layer_num] * direction)]))
+
+        numeric, analytic = np.concatenate(numeric), np.concatenate(analytic)
+        errors.append(np.linalg.norm(numeric - analytic) / max(np.linalg.norm(numeric) + np.linalg.norm(analytic), 10 ** -20))
+    return errors
+
+
+def report(errors, log, tolerance=TOLERANCE):
+    passed = True
+    for layer_num, error in enumerate(errors):
+        layer_passed = error <= tolerance
+        passed = passed and layer_passed
+        log.log("Layer {0}: relative error {1:.3e} {2}".format(layer_num + 1, error, "ok" if layer_passed else "FAILED"))
+    log.log("Gradient check passed" if passed else "Gradient check failed")
+    return passed
+
+
+if __name__ == '__main__':
+
+    # check the main.py topology in float64 on synthetic data, exits with 1 on failure
+    import main
+    nn_params = dict(main.nn_params)
+    nn_params["dtype"] = "float64"
+    log = logger.LOGGER()
+
+    model = Network.Fully_Connected(nn_params)
+    x = np.random.randn(nn_params["layers"][0], BATCH_SIZE)
+    labels = np.random.randint(nn_params["layers"][-1], size=BATCH_SIZE)
+
+    start_time = time.time()
+    errors = check(model, x, labels)
+    passed = report(errors, log)
+    log.log("Checked {0} layers in {1:.2f}s".format(len(errors), time.time() - start_time))
+    sys.exit(0 if passed else 1)
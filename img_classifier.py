@@ -1,10 +1,16 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import Network
-import csv
-import copy
-import pickle
+import checkpoint
+import cifar_reader
+import grad_check
+import logger
+import data_loader
+import parallel
+import profiler
+import writer
 import os
+import time
 
 np.random.seed(222)
 NUM_CLASSES = 10
@@ -27,162 +33,151 @@ def print_img(X, Y):
 
 
 def gradient_check(model, x, y):
-
-    grads = model.get_grads()
-    params = model.get_params()
-
-    eps = 0.00001
-
-    for layer in range(len(params)):
-        for src_neuron in range(np.size(params[layer], 0)):
-            for dst_neuron in range(np.size(params[layer], 1)):
-
-                param_val = params[layer][src_neuron, dst_neuron].copy()
-                grad_val = grads[layer][src_neuron, dst_neuron].copy()
-
-                # compute (loss) function value of epsilon addition to one of the parameters
-                model.init_vals()
-                model.set_param(layer, src_neuron, dst_neuron, param_val + eps)
-                out = model.forward(x)
-                upper_val = model.loss_function(y)
-
-                # compute (loss) function value of epsilon reduction from one of the parameters
-                model.init_vals()
-                model.set_param(layer, src_neuron, dst_neuron, param_val - eps)  # multiply by 2 because the current value is w + epslion
-                out = model.forward(x)
-                lower_val = model.loss_function(y)
-
-                # return to original state
-                model.init_vals()
-                model.set_param(layer, src_neuron, dst_neuron, param_val)
-
-                numeric_grad = (upper_val - lower_val)/(2*eps)
-
-                # Compare gradients
-                reldiff = abs(numeric_grad - grad_val) / max(1, abs(numeric_grad), abs(grad_val))
-                if reldiff > 1e-5:
-                    print("Gradient check failed")
-                    exit()
-    print("Gradient check passed")
-
-
-def read_data(file, dataset="train"):
-    labels = []
-    images = []
-    with open(file) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        for row in csv_reader:
-            if dataset == "train" or dataset == "validation":
-                labels.append(int(row[0]))
-            row_img = np.asarray([float(i) for i in row[1:]])
-            images.append(row_img)
-            if dataset == "train":
-                img = row_img.reshape([img_channels, img_size, img_size])
-                # move the channel dimension to the last
-                img = np.rollaxis(img, 0, 3)
-                permut = np.random.randint(3)
-
-                # flip left to right
-                flippedlr_img = np.fliplr(img)
-                flippedlr_img = np.rollaxis(flippedlr_img, 2, 0)
-                flippedlr_img = flippedlr_img.reshape(img_channels * img_size * img_size)
-                labels.append(int(row[0]))
-                images.append(flippedlr_img)
-
-                # flip up to down
-                flippedud_img = np.flipud(img)
-                flippedud_img = np.rollaxis(flippedud_img, 2, 0)
-                flippedud_img = flippedud_img.reshape(img_channels * img_size * img_size)
-                labels.append(int(row[0]))
-                images.append(flippedud_img)
-
-                # rotate by 90 degrees
-                rot_img = np.transpose(img, (1, 0, 2))
-                rot_img = np.rollaxis(rot_img, 2, 0)
-                rot_img = rot_img.reshape(img_channels * img_size * img_size)
-                labels.append(int(row[0]))
-                images.append(rot_img)
-
-    labels = np.asarray(labels)
-    images = np.asarray(images)
-    return images, labels
-
-
-def z_scaling(X, avg=None, std=None):
-
-    # if X is the train set
+    # y - 0 based class indices, checks a random sample of the parameters and random directions of each layer
+    errors = grad_check.check(model, x, y)
+    if not grad_check.report(errors, logger.LOGGER()):
+        exit()
+
+
+def read_data(file, dataset="train", grayscale=False):
+    # returns a memory mapped dataset, training data is augmented per batch by train_model
+    # file - csv file, or CIFAR pickled batches (a directory of data_batch_* files or a single batch) stored as uint8
+    # and converted to [0, 1] floats, optionally grayscale, when each batch is gathered
+    if cifar_reader.is_batch_path(file):
+        images, labels = cifar_reader.load_batches(file)
+        decode = cifar_reader.Decoder(grayscale)
+    else:
+        if grayscale:
+            raise ValueError("grayscale conversion is only supported for CIFAR batches")
+        images, labels = data_loader.load_csv(file)
+        decode = None
+    return data_loader.Dataset(images, labels if dataset != "test" else None, decode)
+
+
+def read_train_data(file, nn_params):
+    # training set with the augmentation of nn_params applied per batch
+    train_set = read_data(file, "train", nn_params["grayscale"])
+    channels = 1 if nn_params["grayscale"] else img_channels
+    augmentation = data_loader.Augmentation(nn_params["augmentations"], (channels, img_size, img_size))
+    train_set.set_augmentation(augmentation, nn_params["augment_copies"])
+    return train_set
+
+
+def z_scaling(data, avg=None, std=None):
+
+    # if data is the train set
     if avg is None:
-        avg = np.mean(X, axis=0)  # mean for each feature
-        std = np.std(X, axis=0)
+        avg, std = data.feature_stats()  # mean and std for each feature
 
-    scaled_X = (X - avg)/std  # z score scaling
-    return scaled_X, avg, std
+    data.set_scaling(avg, std)  # z score scaling is applied to each gathered batch
+    return data, avg, std
 
 
-def train_model(model, nn_params, log, exp, train_path, val_path, save_logs):
+def train_model(model, nn_params, log, exp, train_path, val_path, save_logs, epoch_callback=None, resume=None, stats=None):
+    # epoch_callback(epoch, val_loss, val_acc) - called after each epoch, training stops when it returns False
+    # resume - full state checkpoint restored into the model, training continues after its epoch
+    # stats - z score (mean, std) of the augmented training set when they were already computed
 
     epochs = nn_params["epochs"]
     batch_size = nn_params["train_batch_size"]
 
     # Initialize printing templates
     per_log_template = '    '.join('{:05d},{:09.5f},{:09.5f},{:06.5f},{:06.5f}'.split(','))
+    ensemble_log_template = '    '.join('{:05d},{:>9},{:09.5f},{:>7},{:06.5f}'.split(','))  # no train metrics
     header_template = ''.join('{:<9},{:<13},{:<13},{:<10},{:<10}'.split(','))
 
     # read data
+    # training batches are augmented on the fly
     log.log("Read Train Data")
-    X_train, Y_train = read_data(train_path, "train")
+    train_set = read_train_data(train_path, nn_params)
     log.log("Read Validation Data")
-    X_val, Y_val = read_data(val_path, "validation")
+    val_set = read_data(val_path, "validation", nn_params["grayscale"])
 
-    # apply z score scaling
+    # apply z score scaling, a resumed run reuses the statistics stored in its checkpoint
+    if stats is None and resume is not None and resume["mean"] is not None:
+        stats = (resume["mean"], resume["std"])
     mean, std = 0, 0
+    scaling = None
     if nn_params["z_scale"]:
-        X_train, mean, std = z_scaling(X_train.copy())
-        X_val, _, __ = z_scaling(X_val.copy(), mean, std)
+        if stats is not None:
+            train_set, mean, std = z_scaling(train_set, *stats)
+        else:
+            train_set, mean, std = z_scaling(train_set)
+        val_set, _, __ = z_scaling(val_set, mean, std)
+        scaling = (mean, std)
+
+    # per phase timers, disabled unless profiling is on
+    trace_path = "./logs/" + exp + "/trace.json" if save_logs and nn_params["profile_trace"] else None
+    prof = profiler.Profiler(nn_params["profile"], trace_path)
+    model.profiler = prof
+
+    # prepare the next batches in background threads while the model trains
+    train_loader = data_loader.Prefetcher(train_set, batch_size, nn_params["loader_workers"], nn_params["prefetch_batches"], prof)
+
+    # shard each batch on several processes, a stack of models trains in a single process
+    stacked = isinstance(model, Network.Stacked_Fully_Connected)
+    if stacked and nn_params["workers"] > 1:
+        raise ValueError("stacked models are trained in a single process, set workers to 1")
+    trainer = parallel.DataParallel(model, nn_params, nn_params["workers"]) if nn_params["workers"] > 1 else None
+
+    # logs, metrics and checkpoints are written in the background
+    async_writer = writer.get_writer()
 
     # initialize experiment params
     best_accu = 0
     best_loss = 10000
-    model_to_save = copy.deepcopy(model)
+    net_norm = np.zeros((0, 3))
+    start_epoch = 1
+    if resume is not None:
+        # random streams are restored last, everything above drew from them as in the interrupted run
+        train_state = checkpoint.restore_training(model, resume)
+        best_accu, best_loss, net_norm = train_state["best_accu"], train_state["best_loss"], train_state["net_norm"].reshape(-1, 3)
+        train_set.order = train_state["order"]  # each shuffle permutes the previous order
+        start_epoch = train_state["epoch"] + 1
+        log.log("Resume after epoch {0}".format(train_state["epoch"]))
+    norms_path = "./logs/" + exp + "/matrix_norms.txt"
+    state_path = "./logs/" + exp + "/last_state.npz"
+    if save_logs:
+        async_writer.save_text(norms_path, net_norm)
     log.log(header_template.format('Epoch', 'Trn_Loss', 'Val_Loss', 'Trn_Acc', ' Val_Acc'))
 
-    for epoch in range(1, epochs + 1):
+    for epoch in range(start_epoch, epochs + 1):
 
         # shuffle examples
-        indices = np.arange(X_train.shape[0])
-        np.random.shuffle(indices)
-        X_train = X_train[indices]
-        Y_train = Y_train[indices]
+        train_set.shuffle()
 
         # initialize epoch params
         cum_loss = 0.0
         correct = 0
+        epoch_start = time.time()
 
-        for ind in range(0, X_train.shape[0], batch_size):
+        for batched_data, labels in train_loader:
 
-            # set the model to train mode, zero gradients and zero activations
+            # set the model to train mode, backward overwrites the gradients of the previous batch
             model.train_time()
-            model.init_vals(True)
-
-            # run the forward pass
-            batched_data = X_train[ind:ind + batch_size].transpose().copy()
-            labels = Y_train[ind:ind + batch_size].copy() - 1
-
-            # from labels to 1-hot
-            labels_vec = np.eye(NUM_CLASSES)[labels].transpose()
-
-            # forward
-            out = model.forward(batched_data)
-            loss = model.loss_function(batched_data, out, labels_vec)
-
-            # compute gradients and make the optimizer step
-            model.backward(batched_data, out, labels_vec)
-            model.step()
+            model.init_vals()
+
+            if trainer is not None:
+                with prof.section("parallel_batch"):
+                    loss, out = trainer.train_batch(batched_data, labels)
+            else:
+                # forward
+                out = model.forward(batched_data)
+                with prof.section("loss"):
+                    loss = model.loss_function(batched_data, out, labels)
+
+                # compute gradients and make the optimizer step
+                with prof.section("backward"):
+                    model.backward(batched_data, out, labels)
+                model.step()
 
             cum_loss += loss  # sum losses on all examples
+            prof.count("examples", batched_data.shape[1])
 
-            pred = np.argmax(out, axis=0)
-            correct += np.sum(labels == pred)
+            pred = np.argmax(out, axis=-2)
+            correct += np.sum(labels == pred, axis=-1)  # per model counts of a stack
+
+        epoch_time = time.time() - epoch_start
 
         # decay learning rate
         if epoch % nn_params["lr_decay_epoch"] == 0:
@@ -192,99 +187,163 @@ def train_model(model, nn_params, log, exp, train_path, val_path, save_logs):
             model.momentum_change()
 
         # average train loss
-        train_loss = cum_loss / X_train.shape[0]
-        train_acc = correct / X_train.shape[0]
+        train_loss = cum_loss / len(train_set)
+        train_acc = correct / len(train_set)
 
         # apply model on validation set
-        val_loss, val_acc = test_model(model, nn_params, exp, X_val, Y_val, save_logs, "val", best_accu)
-
-        # print progress
-        metrics_to_print = str(per_log_template.format(epoch, train_loss, val_loss, train_acc, val_acc))
-        log.log(metrics_to_print)
-
-        # early stopping
-        was_best = False
-        if val_acc > best_accu or (val_acc == best_accu and val_loss < best_loss):
-            model_to_save = copy.deepcopy(model)
-            best_accu = val_acc
-            was_best = True
-
-        # save weights norm
-        net_norm = model.weights_norm() if epoch == 1 else np.concatenate((net_norm, model.weights_norm()), axis=0)
-        if save_logs:
-            np.savetxt("./logs/" + exp + "/matrix_norms.txt", net_norm)
+        with prof.section("validation"):
+            val_loss, val_acc = test_model(model, nn_params, exp, val_set, save_logs, "val", best_accu)
+
+        # print progress, a line for each model of a stack and one for its ensemble
+        if stacked:
+            for member in range(model.n_models):
+                log.log(per_log_template.format(epoch, train_loss[member], val_loss[member], train_acc[member], val_acc[member]) + "    model {0}".format(member))
+            if len(val_acc) > model.n_models:
+                log.log(ensemble_log_template.format(epoch, '-', val_loss[-1], '-', val_acc[-1]) + "    ensemble")
+        else:
+            metrics_to_print = str(per_log_template.format(epoch, train_loss, val_loss, train_acc, val_acc))
+            log.log(metrics_to_print)
+        log.log("Train time {0:.2f}s, data wait {1:.2f}s, compute {2:.2f}s".format(epoch_time, train_loader.wait_time, epoch_time - train_loader.wait_time))
+
+        # early stopping, each model of a stack keeps its own best
+        improved = (val_acc > best_accu) | ((val_acc == best_accu) & (val_loss < best_loss))
+        best_accu = np.where(improved, val_acc, best_accu)
+
+        # save weights norm every norm_epochs epochs, only the rows of this epoch are appended to the file
+        if nn_params["norm_epochs"] > 0 and epoch % nn_params["norm_epochs"] == 0:
+            with prof.section("weights_norm"):
+                epoch_norm = model.weights_norm()
+                net_norm = np.concatenate((net_norm, epoch_norm), axis=0)
+                if save_logs:
+                    async_writer.append_rows(norms_path, epoch_norm)
 
         # save best model
-        if save_logs and was_best:
-            file_name = "/best_model" if nn_params["model"] == "FC" else "/best_model_AE"
-            with open("./logs/" + exp + file_name, 'wb') as best_model:
-                pickle.dump(model_to_save, best_model)
+        if save_logs and np.any(improved):
+            with prof.section("checkpoint"):
+                if stacked:
+                    # a single model checkpoint for each improved model of the stack
+                    for member in np.flatnonzero(improved[:model.n_models]):
+                        member_ckpt = checkpoint.snapshot(model, model.member_params(nn_params, member), scaling=scaling, member=member)
+                        async_writer.submit(checkpoint.write, member_ckpt, "./logs/" + exp + "/best_model_{0}.npz".format(member))
+                else:
+                    file_name = "/best_model.npz" if nn_params["model"] == "FC" else "/best_model_AE.npz"
+                    async_writer.submit(checkpoint.write, checkpoint.snapshot(model, nn_params, scaling=scaling), "./logs/" + exp + file_name)
+
+        # full state to resume from, every checkpoint_epochs epochs
+        if save_logs and nn_params["checkpoint_epochs"] > 0 and epoch % nn_params["checkpoint_epochs"] == 0:
+            train_state = {"epoch": epoch, "best_accu": best_accu, "best_loss": best_loss, "net_norm": net_norm, "order": train_set.order}
+            async_writer.submit(checkpoint.write, checkpoint.state_snapshot(model, nn_params, train_state, scaling), state_path)
+
+        # per phase timing of the epoch
+        for line in prof.summary(time.time() - epoch_start, epoch_time):
+            log.log(line)
+
+        if epoch_callback is not None and not epoch_callback(epoch, val_loss, val_acc):
+            log.log("Stopped after epoch {0}".format(epoch))
+            break
+
+    if trainer is not None:
+        trainer.close()
 
     return model, mean, std
 
 
 # make predictions on dev set
-def test_model(model, nn_params, exp, X, Y, save_logs, dataset="val", best_accu=0):
+def test_model(model, nn_params, exp, data, save_logs, dataset="val", best_accu=0):
 
     batch_size = nn_params["test_batch_size"]
 
     # path for saving test predictions
     test_pred_path = "./logs/" + exp + "/predictions_" + dataset + ".txt" if save_logs else None
 
+    # a stack predicts a row for each model, with ensemble a last row of the averaged probabilities
+    stacked = isinstance(model, Network.Stacked_Fully_Connected)
+    ensemble = stacked and nn_params["ensemble"]
+    rows = (model.n_models + ensemble,) if stacked else ()
+
     # initialize epoch params
     cum_loss = 0.0
     correct = 0
-    for ind in range(0, X.shape[0], batch_size):
-        # set the model to train mode, zero gradients and zero activations
+    n_batches = 0
+    all_preds = np.empty(rows + (len(data),), dtype=np.int64)
+    for ind in range(0, len(data), batch_size):
+        # set the model to test mode, gradients are not needed
         model.test_time()
-        model.init_vals(True)
+        model.init_vals()
 
         # run the forward pass
-        batched_data = X[ind:ind + batch_size].transpose().copy()
+        batched_data, labels = data.batch(ind, batch_size)
 
         # forward
         out = model.forward(batched_data)
 
         # save predictions
-        pred = np.argmax(out, axis=0)
-        all_preds = (pred + 1).copy() if ind == 0 else np.concatenate((all_preds, (pred + 1).copy()))
+        probs = np.concatenate((out, np.mean(out, axis=0, keepdims=True))) if ensemble else out
+        pred = np.argmax(probs, axis=-2)
+        all_preds[..., ind:ind + pred.shape[-1]] = pred + 1
 
         if dataset == "val":
-            # from labels to 1-hot
-            labels = Y[ind:ind + batch_size].copy() - 1
-            labels_vec = np.eye(NUM_CLASSES)[labels].transpose()
-            loss = model.loss_function(batched_data, out, labels_vec)
+            # loss straight from the class indices
+            # the weights are constant here, the regularization term is added once for all the batches
+            labels = labels - 1
+            loss = model.data_loss(labels)
+            if ensemble:
+                loss = np.append(loss, ensemble_loss(probs[-1], labels))
 
             # calc loss and accuracy
             cum_loss += loss
-            correct += np.sum(labels == pred)
+            correct += np.sum(labels == pred, axis=-1)
+            n_batches += 1
+
+    if n_batches > 0:
+        reg_loss = n_batches * model.reg_loss()
+        cum_loss += np.append(reg_loss, 0.0) if ensemble else reg_loss
+    set_loss = cum_loss / len(data)
+    accuracy = correct / len(data)
+
+    # write predictions to file, a file for each model of a stack, the ensemble takes the single model file name
+    if save_logs:
+        improved = (dataset == "test") | ((dataset == "val") & (accuracy > best_accu))
+        if stacked:
+            for row in np.flatnonzero(np.broadcast_to(improved, rows)):
+                row_path = test_pred_path if row == model.n_models else test_pred_path.replace(".txt", "_model{0}.txt".format(row))
+                writer.get_writer().save_text(row_path, all_preds[row], fmt='%d')
+        elif improved:
+            writer.get_writer().save_text(test_pred_path, all_preds.transpose(), fmt='%d')
 
-    set_loss = cum_loss / X.shape[0]
-    accuracy = correct / X.shape[0]
+    return set_loss, accuracy
 
-    # write predictions to file
-    if save_logs and (dataset == "test" or (dataset == "val" and accuracy > best_accu)):
-        np.savetxt(test_pred_path, all_preds.transpose(), fmt='%d')
 
-    return set_loss, accuracy
+def ensemble_loss(probs, labels):
+    # cross entropy of the averaged probabilities of a stack, summed on the examples
+    true_probs = probs[labels, np.arange(labels.size)]
+    return -np.sum(np.log(np.maximum(true_probs, np.finfo(probs.dtype).tiny)))
 
 
-def classifier(nn_params, log, exp, train_path, val_path, test_path, save_logs):
+def classifier(nn_params, log, exp, train_path, val_path, test_path, save_logs, resume=None):
+    # resume - full state checkpoint (checkpoint.read of last_state.npz) to continue training from
 
     # create model and train it
-    model = Network.Fully_Connected(nn_params)
-    if nn_params["load_model"] is not None:
-        with open(nn_params["load_model"], 'rb') as pickle_file:
-            model2 = pickle.load(pickle_file)
-        model.init_weights(model2.weights, model2.accum_grads, model2.sec_accum_grads)
+    model = Network.build(nn_params)
+    if resume is not None:
+        checkpoint.restore(model, resume)
+    elif nn_params["load_model"] is not None:
+        checkpoint.restore(model, checkpoint.read(nn_params["load_model"]), counters=False)
+
+    model, mean, std = train_model(model, nn_params, log, exp, train_path, val_path, save_logs, resume=resume)
 
-    model, mean, std = train_model(model, nn_params, log, exp, train_path, val_path, save_logs)
+    # save the scaling parameters for inference
+    if save_logs and nn_params["z_scale"]:
+        writer.get_writer().submit(np.savez, "./logs/" + exp + "/z_scale.npz", mean=mean, std=std)
 
     # test model
-    X_test, Y_test = read_data(test_path, "test")
+    test_set = read_data(test_path, "test", nn_params["grayscale"])
 
     # apply z score scaling
     if nn_params["z_scale"]:
-        X_test, _, __ = z_scaling(X_test.copy(), mean, std)
+        test_set, _, __ = z_scaling(test_set, mean, std)
+
+    test_model(model, nn_params, exp, test_set, save_logs, "test")
 
-    test_model(model, nn_params, exp, X_test, Y_test, save_logs, "test")
\ No newline at end of file
+    # wait for the background writes to reach the disk
+    writer.get_writer().flush()
\ No newline at end of file
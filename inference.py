@@ -0,0 +1,238 @@
+import json
+import numpy as np
+import sys
+import time
+import Network
+import activations
+import checkpoint
+import data_loader
+import logger
+
+try:
+    import scipy.sparse as sparse  # sparse matmul of pruned layers, dense matmul without it
+except ImportError:
+    sparse = None
+
+BATCH_SIZE = 1024
+TIMING_REPEATS = 3  # passes over the data measure runs, the fastest one is reported
+INT8_MAX = 127  # symmetric int8 range of quantized weights and inputs
+SPARSE_DENSITY = 0.05  # layers with at most this fraction of nonzero weights use csr matmul, it beats BLAS below ~5% on large batches
+
+
+class Predictor:
+    # forward pass only, holds the weights and the per batch buffers and nothing else
+
+    def __init__(self, weights, activation_functions, dtype, batch_size=BATCH_SIZE, mean=None, std=None, max_density=SPARSE_DENSITY):
+        # weights - list of (prev_layer + 1, next_layer) matrices with the bias in the first row
+        # max_density - density of the weights below which a layer is held as a csr matrix, 0 keeps every layer dense
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.activation_functions = list(activation_functions)
+        self.activation_kernels = [activations.get_activation(name) for name in self.activation_functions]
+        self.layers = [weights[0].shape[0] - 1] + [layer_weights.shape[1] for layer_weights in weights]
+        weights = [layer_weights.astype(self.dtype, copy=False) for layer_weights in weights]
+        self.weights = [self.layer_matrix(layer_weights[1:, :].transpose(), max_density) for layer_weights in weights]  # W^T without the bias row
+        self.biases = [layer_weights[0, :].reshape(-1, 1) for layer_weights in weights]
+        self.mean = None if mean is None else np.asarray(mean, dtype=self.dtype)
+        self.std = None if std is None else np.asarray(std, dtype=self.dtype)
+        self.init_buffers()
+
+    def init_buffers(self):
+        # flat buffers, viewed as (rows, batch) so a smaller last batch stays contiguous
+        self.input = np.empty(self.batch_size * self.layers[0], dtype=self.dtype)
+        self.pre_activations = [np.empty(self.batch_size * layer, dtype=self.dtype) for layer in self.layers[1:]]
+
+    @staticmethod
+    def layer_matrix(matrix, max_density):
+        if sparse is not None and np.count_nonzero(matrix) <= max_density * matrix.size:
+            return sparse.csr_matrix(matrix)
+        return matrix
+
+    def weights_nbytes(self):
+        # memory of the weight matrices, values and indices of the sparse ones
+        return sum(weights.data.nbytes + weights.indices.nbytes + weights.indptr.nbytes if sparse is not None and sparse.issparse(weights) else weights.nbytes
+                   for weights in self.weights)
+
+    def forward(self, x, out):
+        # x - examples in rows, out - (classes, examples) view to write the network output to
+        n_examples = x.shape[0]
+        act = self.input[:n_examples * self.layers[0]].reshape(n_examples, -1)
+        act[...] = x
+        if self.mean is not None:
+            act -= self.mean
+            act /= self.std
+        act = act.transpose()
+
+        for layer_num in range(len(self.layers) - 1):
+            z = self.pre_activations[layer_num][:n_examples * self.layers[layer_num + 1]].reshape(-1, n_examples)
+            self.linear(layer_num, act, z)  # z = Wx + b
+            z += self.biases[layer_num]
+            act = self.activation_kernels[layer_num].forward(z, out if layer_num == len(self.layers) - 2 else z)
+        return out
+
+    def linear(self, layer_num, act, z):
+        weights = self.weights[layer_num]
+        if sparse is not None and sparse.issparse(weights):
+            z[...] = weights @ act
+        else:
+            np.dot(weights, act, out=z)
+
+    def predict_proba(self, images):
+        # network output of all examples, written batch by batch into a preallocated array
+        probs = np.empty((images.shape[0], self.layers[-1]), dtype=self.dtype)
+        for ind in range(0, images.shape[0], self.batch_size):
+            batch = images[ind:ind + self.batch_size]
+            self.forward(batch, probs[ind:ind + batch.shape[0]].transpose())
+        return probs
+
+    def predict(self, images):
+        # predicted labels (1 based, like the data files) without keeping the outputs of all examples
+        preds = np.empty(images.shape[0], dtype=np.int64)
+        out = np.empty((self.batch_size, self.layers[-1]), dtype=self.dtype)
+        for ind in range(0, images.shape[0], self.batch_size):
+            batch = images[ind:ind + self.batch_size]
+            batch_out = self.forward(batch, out[:batch.shape[0]].transpose())
+            np.argmax(batch_out, axis=0, out=preds[ind:ind + batch.shape[0]])
+            preds[ind:ind + batch.shape[0]] += 1
+        return preds
+
+
+class QuantizedPredictor(Predictor):
+    # int8 weights with a float32 scale per output unit (or per layer), the input of each layer is quantized to int8 with a calibrated scale
+    # NumPy has no int8 GEMM, float32 accumulation multiplies the int8 values with BLAS in float32, a layer at a time,
+    # int32 accumulation is exact integer arithmetic without BLAS
+
+    def __init__(self, qweights, weight_scales, biases, input_scales, activation_functions, batch_size=BATCH_SIZE, mean=None, std=None, accumulation="float32"):
+        # qweights - list of int8 (next_layer, prev_layer) matrices, weight_scales - (next_layer, 1) or (1, 1) scales of their rows
+        # biases - (next_layer, 1) float biases, input_scales - scale of the input of each layer
+        self.batch_size = batch_size
+        self.dtype = np.dtype(np.float32)
+        self.activation_functions = list(activation_functions)
+        self.activation_kernels = [activations.get_activation(name) for name in self.activation_functions]
+        self.layers = [qweights[0].shape[1]] + [layer_weights.shape[0] for layer_weights in qweights]
+        self.qweights = [np.ascontiguousarray(layer_weights, dtype=np.int8) for layer_weights in qweights]
+        self.weight_scales = [np.asarray(scales, dtype=self.dtype) for scales in weight_scales]
+        self.biases = [np.asarray(bias, dtype=self.dtype) for bias in biases]
+        self.input_scales = np.asarray(input_scales, dtype=self.dtype)
+        self.accumulation = accumulation
+        self.mean = None if mean is None else np.asarray(mean, dtype=self.dtype)
+        self.std = None if std is None else np.asarray(std, dtype=self.dtype)
+        self.init_buffers()
+
+    def init_buffers(self):
+        super().init_buffers()
+        self.quantized_input = np.empty(self.batch_size * max(self.layers[:-1]), dtype=self.dtype)  # int8 values of a layer input
+        self.weights_buffer = np.empty(max(layer_weights.size for layer_weights in self.qweights), dtype=self.dtype) if self.accumulation == "float32" else None
+
+    def weights_nbytes(self):
+        return sum(layer_weights.nbytes + scales.nbytes for layer_weights, scales in zip(self.qweights, self.weight_scales))
+
+    def linear(self, layer_num, act, z):
+        # z = s_w * s_x * (W_q x_q), x_q = round(x / s_x) clipped to the int8 range
+        input_scale = self.input_scales[layer_num]
+        xq = self.quantized_input[:act.size].reshape(act.shape)
+        np.multiply(act, 1 / input_scale, out=xq)
+        np.rint(xq, out=xq)
+        np.clip(xq, -INT8_MAX, INT8_MAX, out=xq)
+
+        qweights = self.qweights[layer_num]
+        if self.accumulation == "int32":
+            z[...] = np.dot(qweights.astype(np.int32), xq.astype(np.int32))
+        else:
+            weights = self.weights_buffer[:qweights.size].reshape(qweights.shape)
+            np.copyto(weights, qweights)  # int8 values and their products are exact in float32
+            np.dot(weights, xq, out=z)
+        z *= self.weight_scales[layer_num] * input_scale
+
+    def arrays(self, nn_params):
+        # arrays of a quantized model file
+        arrays = {"format_version": np.asarray(checkpoint.FORMAT_VERSION), "nn_params": np.asarray(json.dumps(nn_params)), "input_scales": self.input_scales}
+        if self.mean is not None:
+            arrays["scaling_mean"], arrays["scaling_std"] = self.mean, self.std
+        for layer_num in range(len(self.layers) - 1):
+            arrays["qweights_" + str(layer_num)] = self.qweights[layer_num]
+            arrays["weight_scales_" + str(layer_num)] = self.weight_scales[layer_num]
+            arrays["biases_" + str(layer_num)] = self.biases[layer_num]
+        return arrays
+
+
+def measure(predictor, batches):
+    # accuracy and examples/sec of the forward passes on batches of (examples in rows, 1 based labels)
+    # the fastest of TIMING_REPEATS passes is reported, only the forward passes are timed
+    n_examples = sum(labels.size for _, labels in batches)
+    out = np.empty((predictor.batch_size, predictor.layers[-1]), dtype=predictor.dtype)
+    best_time = float("inf")
+    for _ in range(TIMING_REPEATS):
+        correct = 0
+        elapsed = 0.0
+        for batched_data, labels in batches:
+            start = time.perf_counter()
+            batch_out = predictor.forward(batched_data, out[:labels.size].transpose())
+            elapsed += time.perf_counter() - start
+            correct += np.sum(np.argmax(batch_out, axis=0) + 1 == labels)
+        best_time = min(best_time, elapsed)
+    return correct / n_examples, n_examples / best_time
+
+
+def load_quantized_predictor(path, batch_size=BATCH_SIZE, mean=None, std=None, accumulation="float32"):
+    with np.load(path, allow_pickle=False) as data:
+        nn_params = json.loads(str(data["nn_params"]))
+        n_layers = len(nn_params["layers"]) - 1
+        if mean is None and "scaling_mean" in data.files:
+            mean, std = data["scaling_mean"], data["scaling_std"]
+        qweights = [data["qweights_" + str(layer_num)] for layer_num in range(n_layers)]
+        weight_scales = [data["weight_scales_" + str(layer_num)] for layer_num in range(n_layers)]
+        biases = [data["biases_" + str(layer_num)] for layer_num in range(n_layers)]
+        input_scales = data["input_scales"]
+    return QuantizedPredictor(qweights, weight_scales, biases, input_scales, nn_params["activations"], batch_size, mean, std, accumulation)
+
+
+def is_quantized(path):
+    with np.load(path, allow_pickle=False) as data:
+        return "qweights_0" in data.files
+
+
+def load_predictor(path, batch_size=BATCH_SIZE, mean=None, std=None, max_density=SPARSE_DENSITY):
+    # weights only, the optimizer moments are not read
+    # the input scaling stored in the checkpoint is used unless mean and std are given
+    if is_quantized(path):
+        return load_quantized_predictor(path, batch_size, mean, std)
+    ckpt = checkpoint.read(path, moments=False)
+    nn_params = ckpt["nn_params"]
+    if mean is None and ckpt["mean"] is not None:
+        mean, std = ckpt["mean"], ckpt["std"]
+    return Predictor(ckpt["weights"], nn_params["activations"], Network.DTYPES[nn_params["dtype"]][0], batch_size, mean, std, max_density)
+
+
+def load_images(path):
+    # .npy files are memory mapped, csv files are read through the binary cache
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode='r')
+    images, _ = data_loader.load_csv(path)
+    return images
+
+
+if __name__ == '__main__':
+
+    # inference.py <model, a checkpoint or a quantized model> <input .csv/.npy> <output .txt for labels/.npy for probabilities> [<z scale .npz>]
+    # the z scale file is only needed for checkpoints saved without their input scaling
+    model_path = sys.argv[1]
+    input_path = sys.argv[2]
+    output_path = sys.argv[3]
+    stats_path = sys.argv[4] if len(sys.argv) > 4 else None
+
+    log = logger.LOGGER()
+    mean, std = None, None
+    if stats_path is not None:
+        stats = np.load(stats_path)
+        mean, std = stats["mean"], stats["std"]
+    predictor = load_predictor(model_path, BATCH_SIZE, mean, std)
+    images = load_images(input_path)
+
+    start_time = time.time()
+    if output_path.endswith(".npy"):
+        np.save(output_path, predictor.predict_proba(images))
+    else:
+        np.savetxt(output_path, predictor.predict(images), fmt='%d')
+    elapsed = time.time() - start_time
+    log.log("Scored {0} examples in {1:.2f}s ({2:.0f} examples/sec)".format(images.shape[0], elapsed, images.shape[0] / elapsed))
@@ -1,11 +1,13 @@
 import datetime
 import sys
+import writer
 
 
 class LOGGER(object):
 
-    def __init__(self, log_path=None):
+    def __init__(self, log_path=None, echo=True):
         self.log_path = log_path
+        self.echo = echo  # print to screen as well as to the log file
 
     def log(self, message):
         # put output into frame
@@ -14,10 +16,14 @@ class LOGGER(object):
         to_print = str_to_print % (datetime_string, str(message))
 
         # print to screen
-        sys.stdout.write(to_print)
-        sys.stdout.flush()
+        if self.echo:
+            sys.stdout.write(to_print)
+            sys.stdout.flush()
 
-        # write to log file
+        # lines of the log file are buffered and written by the background writer
         if self.log_path is not None:
-            with open(self.log_path, 'a') as f:
-                f.write(to_print)
+            writer.get_writer().append_lines(self.log_path, [to_print])
+
+    def flush(self):
+        if self.log_path is not None:
+            writer.get_writer().flush()
@@ -1,3 +1,4 @@
+import checkpoint
 import logger
 import img_classifier
 import os
@@ -22,11 +23,25 @@ nn_params["test_batch_size"] = 128
 nn_params["layers"] = [3072, 2000, 500, 2000, 10]  # MLP dims
 nn_params["activations"] = ['relu', 'linear', 'relu', 'softmax']  # tanh, relu or softmax
 nn_params["dropout"] = [0.2, 0.5, 0.2, 0.5]  # dropout on each layer
+nn_params["dtype"] = "float64"  # float64, float32 or mixed (float32 compute with float64 master weights)
 nn_params["z_scale"] = True
+nn_params["grayscale"] = False  # CIFAR batches only, the first layer has 1024 inputs when set
+nn_params["augmentations"] = {"none": 0.25, "fliplr": 0.25, "flipud": 0.25, "transpose": 0.25}  # probability of each transform per training example
+nn_params["augment_copies"] = 4  # passes over the training data in each epoch
+nn_params["loader_workers"] = 2  # threads preparing training batches, 0 prepares them in the training loop
+nn_params["prefetch_batches"] = 4  # batches prepared ahead of the training loop
+nn_params["workers"] = 1  # processes for data parallel training, 1 trains in this process
+nn_params["models"] = 1  # models of the same topology trained together in one batched pass, each with its own initialization
+nn_params["model_variants"] = None  # per model overrides of lr, reg_lambda and dropout, e.g. [{"lr": 0.001}, {"dropout": [0.5, 0.5, 0.5, 0.5]}]
+nn_params["ensemble"] = False  # also evaluate and predict with the averaged probabilities of the stacked models
+nn_params["checkpoint_epochs"] = 1  # epochs between full state checkpoints to resume from, 0 disables them
+nn_params["norm_epochs"] = 1  # epochs between weight norm measurements, 0 disables them
+nn_params["profile"] = False  # log per phase timing, throughput and peak memory after each epoch
+nn_params["profile_trace"] = False  # also write a chrome trace of every timed section to the logs directory
 nn_params["load_model"] = None
 
 
-def print_data(log):
+def print_data(log, nn_params):
 
     # print hyper-parameters
     for key, val in nn_params.items():
@@ -36,19 +51,33 @@ def print_data(log):
 
 if __name__ == '__main__':
 
-    save_logs = sys.argv[1].lower() == 'true'
-    train_path = sys.argv[2]
-    val_path = sys.argv[3]
-    test_path = sys.argv[4]
+    # main.py <save_logs> <train> <val> <test> [--resume <experiment>]
+    args = sys.argv[1:]
+    resume_exp = None
+    if "--resume" in args:
+        ind = args.index("--resume")
+        resume_exp = args[ind + 1]
+        del args[ind:ind + 2]
+    save_logs = args[0].lower() == 'true'
+    train_path = args[1]
+    val_path = args[2]
+    test_path = args[3]
 
-    exp = strftime("%Y.%m.%d_%H:%M:%S", gmtime())
+    resume = None
+    if resume_exp is not None:
+        # continue an interrupted experiment with its own hyper-parameters
+        exp = resume_exp
+        resume = checkpoint.read("./logs/" + exp + "/last_state.npz")
+        nn_params = resume["nn_params"]
+    else:
+        exp = strftime("%Y.%m.%d_%H:%M:%S", gmtime())
     # create directory for logs if not exist
     if save_logs:
         os.makedirs(os.path.dirname("./logs/" + exp + "/"), exist_ok=True)
         log = logger.LOGGER("./logs/" + exp + "/log")  # create log instance
     else:
         log = logger.LOGGER()  # create log instance
-    print_data(log)  # print experiment parameters
+    print_data(log, nn_params)  # print experiment parameters
 
     # classify - good luck!
-    img_classifier.classifier(nn_params, log, exp, train_path, val_path, test_path, save_logs)
\ No newline at end of file
+    img_classifier.classifier(nn_params, log, exp, train_path, val_path, test_path, save_logs, resume)
\ No newline at end of file
@@ -0,0 +1,107 @@
+import numpy as np
+
+# parameters of the learning rate schedules
+MIN_LR = 0.0001
+LR_SCALE = 2
+EPSILON = 10 ** -8
+
+
+class Optimizer:
+    # regularization is added to the loss and its gradient, otherwise it is applied as weight decay in the step
+    reg_in_loss = True
+
+    def __init__(self):
+        self.scratch = None  # preallocated per layer scratch buffers
+
+    def get_scratch(self, model, n_buffers, grads_buffer=False):
+        # n_buffers in the master weights dtype and optionally one in the gradients dtype, shared when the dtypes are the same
+        if self.scratch is None:
+            self.scratch = []
+            for weights, grads in zip(model.weights, model.grads):
+                buffers = [np.empty_like(weights) for _ in range(n_buffers)]
+                if grads_buffer:
+                    buffers.append(buffers[0] if grads.dtype == weights.dtype else np.empty_like(grads))
+                self.scratch.append(buffers)
+        return self.scratch
+
+    def step(self, model):
+        raise NotImplementedError
+
+    def decay_lr(self, model):
+        raise NotImplementedError
+
+
+class SGD(Optimizer):
+    # Nesterov momentum
+
+    def step(self, model):
+        scratch = self.get_scratch(model, 1)
+        for layer_num in range(len(model.weights)):
+            weights, accum_grads, grads = model.weights[layer_num], model.accum_grads[layer_num], model.grads[layer_num]
+            tmp, = scratch[layer_num]
+
+            # w = w - momentum * v_prev + (1 + momentum) * v
+            np.multiply(accum_grads, model.momentum, out=tmp)
+            weights -= tmp
+
+            # v = momentum * v_prev - lr * grads
+            accum_grads *= model.momentum
+            np.multiply(grads, model.lr, out=tmp)
+            accum_grads -= tmp
+
+            np.multiply(accum_grads, 1 + model.momentum, out=tmp)
+            weights += tmp
+
+    def decay_lr(self, model):
+        if np.ndim(model.lr):
+            model.lr = np.maximum(model.lr / LR_SCALE, MIN_LR)  # per model learning rates of a stack
+        else:
+            model.lr = max(MIN_LR, model.lr / LR_SCALE)  # cut by halve each time
+
+
+class Adam(Optimizer):
+    # ADAM with decoupled weight decay
+    reg_in_loss = False
+
+    def step(self, model):
+        scratch = self.get_scratch(model, 2, grads_buffer=True)
+        first_correction = 1 - (model.momentum ** model.update_counter)
+        second_correction = 1 - (model.second_moment ** model.update_counter)
+        for layer_num in range(len(model.weights)):
+            weights, grads = model.weights[layer_num], model.grads[layer_num]
+            accum_grads, sec_accum_grads = model.accum_grads[layer_num], model.sec_accum_grads[layer_num]
+            tmp, denom, grads_tmp = scratch[layer_num]
+
+            # moments update
+            accum_grads *= model.momentum
+            np.multiply(grads, 1 - model.momentum, out=tmp)
+            accum_grads += tmp
+            sec_accum_grads *= model.second_moment
+            np.square(grads, out=grads_tmp)
+            grads_tmp *= 1 - model.second_moment
+            sec_accum_grads += grads_tmp
+
+            # bias corrected step lr * m_hat / (sqrt(v_hat) + eps)
+            np.divide(accum_grads, first_correction, out=tmp)
+            tmp *= model.lr
+            np.divide(sec_accum_grads, second_correction, out=denom)
+            np.sqrt(denom, out=denom)
+            denom += EPSILON
+            tmp /= denom
+
+            # weight decay on the weights before the step
+            np.multiply(weights, model.reg, out=denom)
+            weights -= tmp
+            weights -= denom
+
+    def decay_lr(self, model):
+        # decay lr and regularization at each epoch
+        model.lr = model.initial_lr / float(np.sqrt(model.epoch))  # python floats keep the weights dtype
+        model.reg = model.initilal_reg / float(np.sqrt(model.epoch))
+
+
+OPTIMIZERS = {"SGD": SGD, "ADAM": Adam}
+
+
+def get_optimizer(name):
+    return OPTIMIZERS[name.upper()]()
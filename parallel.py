@@ -0,0 +1,196 @@
+import atexit
+import contextlib
+import multiprocessing as mp
+import os
+import numpy as np
+from multiprocessing import shared_memory
+import Network
+
+# each worker runs single threaded BLAS so the processes do not oversubscribe the cores
+BLAS_THREADS_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+@contextlib.contextmanager
+def blas_threads(n_threads):
+    # processes started in the block run n_threads BLAS threads, the environment of this process is restored after it
+    saved_env = {var: os.environ.get(var) for var in BLAS_THREADS_VARS}
+    os.environ.update({var: str(n_threads) for var in BLAS_THREADS_VARS})
+    try:
+        yield
+    finally:
+        for var, val in saved_env.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
+
+
+def shared_array(shape, dtype, name=None):
+    # create (or attach to, when name is given) a numpy array in shared memory
+    size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def row_slices(n_rows, n_workers):
+    # contiguous rows of a gradient matrix reduced by each worker
+    bounds = np.linspace(0, n_rows, n_workers + 1).astype(int)
+    return [slice(start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def worker(worker_num, nn_params, seed, layout, conn):
+    # attach to the shared weights, data and gradient buffers
+    handles = {}
+    arrays = {}
+    for key, (name, shape, dtype) in layout.items():
+        handles[key], arrays[key] = shared_array(shape, dtype, name)
+
+    # replica that reads the shared weights, moments are never needed here
+    # backward writes the gradients of the shard straight to this worker's shared slot
+    n_layers = len(nn_params["layers"]) - 1
+    model = Network.Fully_Connected(nn_params)
+    model.weights = model.compute_weights = [arrays["weights_" + str(layer_num)] for layer_num in range(n_layers)]
+    model.grads = [arrays["grads_" + str(layer_num)][worker_num] for layer_num in range(n_layers)]
+    model.accum_grads = model.sec_accum_grads = None
+    model.rng = np.random.default_rng(seed)
+
+    # rows of each layer this worker reduces over the slots of all workers
+    slots = [arrays["grads_" + str(layer_num)] for layer_num in range(n_layers)]
+    reduced = [arrays["reduced_" + str(layer_num)] for layer_num in range(n_layers)]
+    rows = [row_slices(layer_grads.shape[0], len(layer_slots))[worker_num] for layer_grads, layer_slots in zip(reduced, slots)]
+    batched_data = labels = out = None
+
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+
+        if command[0] == "reduce":
+            # reduce scatter, the shard weighted sum of this worker's rows, scaled in place in the slots
+            _, active, shard_weights = command
+            for layer_num in range(n_layers):
+                dst = reduced[layer_num][rows[layer_num]]
+                for ind, (worker_ind, weight) in enumerate(zip(active, shard_weights)):
+                    src = slots[layer_num][worker_ind][rows[layer_num]]
+                    if ind == 0:
+                        np.multiply(src, weight, out=dst)
+                    else:
+                        src *= weight
+                        dst += src
+            conn.send(None)
+            continue
+
+        _, start, end, reg = command
+        model.reg = reg
+
+        # forward and backward on this worker's shard of the global batch
+        model.train_time()
+        model.init_vals()
+        batched_data = arrays["data"][:, start:end]
+        labels = arrays["labels"][start:end]
+        out = model.forward(batched_data)
+        arrays["out"][:, start:end] = out
+        loss = model.data_loss(labels)
+        model.backward(batched_data, out, labels)
+        conn.send(loss)
+
+    # views on the shared buffers must be released before closing them
+    del model, slots, reduced, arrays, batched_data, labels, out
+    for shm in handles.values():
+        shm.close()
+
+
+class DataParallel:
+
+    def __init__(self, model, nn_params, n_workers):
+        self.model = model
+        self.n_workers = n_workers
+        self.batch_size = nn_params["train_batch_size"]
+        self.handles = []
+        self.closed = False
+        layout = {}
+
+        def share(key, shape, dtype):
+            shm, array = shared_array(shape, dtype)
+            self.handles.append(shm)
+            layout[key] = (shm.name, shape, np.dtype(dtype).str)
+            return array
+
+        # move the weights the forward pass uses to shared memory, the optimizer updates them in place
+        shared_weights = []
+        for layer_num, weights in enumerate(model.compute_weights):
+            shared = share("weights_" + str(layer_num), weights.shape, weights.dtype)
+            shared[...] = weights
+            shared_weights.append(shared)
+        if model.compute_weights is model.weights:
+            model.weights = model.compute_weights = shared_weights
+        else:
+            model.compute_weights = shared_weights
+
+        # per worker gradients, the reduced gradients the optimizer steps on and the global batch
+        self.grads = [share("grads_" + str(layer_num), (n_workers,) + grads.shape, model.dtype) for layer_num, grads in enumerate(model.grads)]
+        model.grads = [share("reduced_" + str(layer_num), grads.shape, model.dtype) for layer_num, grads in enumerate(model.grads)]
+        self.data = share("data", (model.layers[0], self.batch_size), model.dtype)
+        self.labels = share("labels", (self.batch_size,), np.int64)  # 0 based class indices
+        self.out = share("out", (model.layers[-1], self.batch_size), model.dtype)
+
+        # start the workers with single threaded BLAS
+        context = mp.get_context("spawn")
+        self.conns = []
+        self.processes = []
+        with blas_threads(1):
+            for worker_num in range(n_workers):
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(target=worker, args=(worker_num, nn_params, np.random.randint(2 ** 31), layout, child_conn), daemon=True)
+                process.start()
+                self.conns.append(parent_conn)
+                self.processes.append(process)
+
+        # release the shared memory even if training stops with an error
+        atexit.register(self.close)
+
+    def train_batch(self, batched_data, labels):
+        # shard the batch on the workers, reduce their gradients in the workers and make a single optimizer step
+        batch_size = batched_data.shape[1]
+        self.data[:, :batch_size] = batched_data
+        self.labels[:batch_size] = labels
+
+        bounds = np.linspace(0, batch_size, self.n_workers + 1).astype(int)
+        active = [worker_num for worker_num in range(self.n_workers) if bounds[worker_num + 1] > bounds[worker_num]]
+        for worker_num in active:
+            self.conns[worker_num].send(("batch", bounds[worker_num], bounds[worker_num + 1], self.model.reg))
+        loss = sum(self.conns[worker_num].recv() for worker_num in active)
+
+        # each worker averaged on its shard, the shards are weighted by their size
+        # every worker sums its rows of the gradients over the slots, into the shared gradients of the model
+        shard_weights = [(bounds[worker_num + 1] - bounds[worker_num]) / batch_size for worker_num in active]
+        for conn in self.conns:
+            conn.send(("reduce", active, shard_weights))
+        for conn in self.conns:
+            conn.recv()
+
+        loss += self.model.reg_loss()
+        self.model.step()
+        return loss, self.out[:, :batch_size]
+
+    def close(self):
+        # stop the workers and move the weights back to private memory
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+
+        private_weights = [weights.copy() for weights in self.model.compute_weights]
+        if self.model.compute_weights is self.model.weights:
+            self.model.weights = self.model.compute_weights = private_weights
+        else:
+            self.model.compute_weights = private_weights
+        self.model.grads = [grads.copy() for grads in self.model.grads]
+
+        self.grads = self.data = self.labels = self.out = None
+        for shm in self.handles:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,105 @@
+import json
+import sys
+import time
+
+try:
+    import resource  # peak memory, not available on windows
+except ImportError:
+    resource = None
+
+
+class NullSection:
+    # returned by a disabled profiler, entering and exiting it does nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_SECTION = NullSection()
+
+
+class Section:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, self.start, time.perf_counter())
+        return False
+
+
+def peak_memory_mb():
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10  # bytes on mac, kilobytes on linux
+
+
+class Profiler:
+
+    def __init__(self, enabled=False, trace_path=None):
+        self.enabled = enabled
+        self.trace_path = trace_path if enabled else None  # chrome trace (chrome://tracing, perfetto) of every section
+        self.totals = {}  # section name -> [seconds, calls] in the current epoch
+        self.counters = {}  # counter name -> value in the current epoch
+        self.events = []  # trace events not written yet
+        self.origin = time.perf_counter()
+        if self.trace_path is not None:
+            with open(self.trace_path, 'w') as f:
+                f.write("[\n")
+
+    def section(self, name):
+        # time a block of code: with profiler.section("name"): ...
+        if not self.enabled:
+            return NULL_SECTION
+        return Section(self, name)
+
+    def add(self, name, start, end):
+        total = self.totals.setdefault(name, [0.0, 0])
+        total[0] += end - start
+        total[1] += 1
+        if self.trace_path is not None:
+            self.events.append((name, start, end))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, elapsed, train_time=None):
+        # per section summary of the epoch, flushes the trace and resets the epoch totals
+        # elapsed - epoch time, train_time - time of the training batches used for the throughput
+        if not self.enabled:
+            return []
+        lines = ["{0:<20}{1:>10}{2:>10}{3:>8}".format("Section", "Time(s)", "Calls", "%")]
+        for name, (seconds, calls) in sorted(self.totals.items(), key=lambda item: -item[1][0]):
+            lines.append("{0:<20}{1:>10.3f}{2:>10d}{3:>8.1f}".format(name, seconds, calls, 100 * seconds / elapsed))
+        if "examples" in self.counters:
+            lines.append("examples/sec {0:.1f}".format(self.counters["examples"] / (elapsed if train_time is None else train_time)))
+        lines.append("peak memory {0:.1f} MB".format(peak_memory_mb()))
+
+        self.flush()
+        self.totals = {}
+        self.counters = {}
+        return lines
+
+    def flush(self):
+        if self.trace_path is None or not self.events:
+            return
+        with open(self.trace_path, 'a') as f:
+            for name, start, end in self.events:
+                event = {"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": (start - self.origin) * 10 ** 6, "dur": (end - start) * 10 ** 6}
+                f.write(json.dumps(event) + ",\n")
+        self.events = []
+
+
+# disabled profiler used when profiling is off
+NULL = Profiler()
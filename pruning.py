@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+import numpy as np
+import Network
+import checkpoint
+import img_classifier
+import inference
+import logger
+from time import gmtime, strftime
+
+SPARSITIES = [0.0, 0.5, 0.8, 0.9, 0.95, 0.98]  # fractions of the weights pruned in the report
+
+
+def magnitude_masks(weights, sparsity, per_layer=False):
+    # masks keeping the largest magnitude weights, bias rows are never pruned
+    # global pruning ranks the weights of all layers together, per layer pruning removes the same fraction of each layer
+    if per_layer:
+        return [magnitude_masks([layer_weights], sparsity)[0] for layer_weights in weights]
+    magnitudes = np.concatenate([np.abs(layer_weights[1:, :]).ravel() for layer_weights in weights])
+    n_pruned = int(round(sparsity * magnitudes.size))
+    threshold = np.partition(magnitudes, n_pruned - 1)[n_pruned - 1] if n_pruned > 0 else -1.0
+    masks = []
+    for layer_weights in weights:
+        mask = np.abs(layer_weights) > threshold
+        mask[0, :] = True
+        masks.append(mask)
+    return masks
+
+
+def prune(model, sparsity, per_layer=False):
+    # zero the smallest weights, they stay zero when the model is trained further
+    model.set_masks(magnitude_masks(model.weights, sparsity, per_layer))
+
+
+def density(weights):
+    # fraction of nonzero weights, bias rows excluded
+    return sum(np.count_nonzero(layer_weights[1:, :]) for layer_weights in weights) / sum(layer_weights[1:, :].size for layer_weights in weights)
+
+
+if __name__ == '__main__':
+
+    # pruning.py <save_logs> <checkpoint .npz> <val> [<sparsities, e.g. 0.5,0.9,0.95> [<global|layer> [<fine tune epochs> <train>]]]
+    # prunes the checkpoint at each sparsity, fine tunes it with fixed masks, and reports the accuracy vs latency and memory
+    # of dense and sparse inference, the pruned weights are exported in csr checkpoints
+    save_logs = sys.argv[1].lower() == 'true'
+    ckpt_path = sys.argv[2]
+    val_path = sys.argv[3]
+    sparsities = [float(sparsity) for sparsity in sys.argv[4].split(",")] if len(sys.argv) > 4 else SPARSITIES
+    per_layer = len(sys.argv) > 5 and sys.argv[5].lower() == "layer"
+    fine_tune_epochs = int(sys.argv[6]) if len(sys.argv) > 6 else 0
+    train_path = sys.argv[7] if len(sys.argv) > 7 else None
+
+    exp = "prune_" + strftime("%Y.%m.%d_%H:%M:%S", gmtime())
+    if save_logs:
+        os.makedirs("./logs/" + exp, exist_ok=True)
+    log = logger.LOGGER("./logs/" + exp + "/log" if save_logs else None)
+
+    ckpt = checkpoint.read(ckpt_path, moments=False)
+    nn_params = ckpt["nn_params"]
+    dtype = Network.DTYPES[nn_params["dtype"]][0]
+    scaling = None if ckpt["mean"] is None else (ckpt["mean"], ckpt["std"])
+
+    # validation batches are gathered once, only the forward passes are timed
+    val_set = img_classifier.read_data(val_path, "validation", nn_params["grayscale"])
+    batches = [(batched_data.transpose(), labels) for batched_data, labels in val_set.batches(inference.BATCH_SIZE)]
+
+    results = []
+    for sparsity in sparsities:
+        model = checkpoint.load(ckpt_path)
+        prune(model, sparsity, per_layer)
+        if fine_tune_epochs > 0:
+            log.log("Fine tune at sparsity {0}".format(sparsity))
+            run = exp + "/sparsity_{0}".format(sparsity)
+            if save_logs:
+                os.makedirs("./logs/" + run, exist_ok=True)
+            img_classifier.train_model(model, dict(nn_params, epochs=fine_tune_epochs), log, run, train_path, val_path, save_logs)
+
+        result = {"sparsity": sparsity, "density": density(model.weights)}
+        for mode, max_density in [("dense", 0.0), ("sparse", inference.SPARSE_DENSITY)]:
+            predictor = inference.Predictor(model.weights, nn_params["activations"], dtype, inference.BATCH_SIZE, ckpt["mean"], ckpt["std"], max_density)
+            accuracy, throughput = inference.measure(predictor, batches)
+            result[mode] = {"val_acc": accuracy, "examples_per_sec": throughput, "weights_mb": predictor.weights_nbytes() / 2 ** 20}
+        results.append(result)
+
+        if save_logs:
+            checkpoint.save(model, "./logs/" + exp + "/pruned_{0}.npz".format(sparsity), nn_params, moments=False, scaling=scaling, sparse=True)
+
+    # accuracy vs latency and memory, sparse inference is dense when scipy is missing or the layers are too dense
+    header_template = "{0:<10}{1:<9}{2:<10}{3:<12}{4:<12}{5:<10}{6}"
+    row_template = "{0:<10.3f}{1:<9.4f}{2:<10.5f}{3:<12.1f}{4:<12.1f}{5:<10.2f}{6:.2f}"
+    log.log(header_template.format("Sparsity", "Density", "Val_Acc", "Dense_ex/s", "Sparse_ex/s", "Dense_MB", "Sparse_MB"))
+    for result in results:
+        dense, sparse = result["dense"], result["sparse"]
+        log.log(row_template.format(result["sparsity"], result["density"], sparse["val_acc"], dense["examples_per_sec"], sparse["examples_per_sec"], dense["weights_mb"], sparse["weights_mb"]))
+    if save_logs:
+        with open("./logs/" + exp + "/report.json", 'w') as f:
+            json.dump(results, f, indent=2)
+    log.flush()
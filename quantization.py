@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+import numpy as np
+import Network
+import checkpoint
+import img_classifier
+import inference
+import logger
+from time import gmtime, strftime
+
+CALIBRATION_EXAMPLES = 1024  # validation examples the input ranges are calibrated on
+CALIBRATION_PERCENTILE = 99.99  # percentile of the absolute input values mapped to the int8 range, rare outliers are clipped
+MIN_SCALE = 10 ** -12  # scale of all zero rows and inputs
+
+
+def quantize_matrix(matrix, per_channel=True):
+    # symmetric int8 values of a (rows, cols) matrix and the float32 scale of each row, or of the whole matrix
+    max_abs = np.max(np.abs(matrix), axis=1, keepdims=True) if per_channel else np.max(np.abs(matrix)).reshape(1, 1)
+    scales = (np.maximum(max_abs, MIN_SCALE) / inference.INT8_MAX).astype(np.float32)
+    qmatrix = np.clip(np.rint(matrix / scales), -inference.INT8_MAX, inference.INT8_MAX).astype(np.int8)
+    return qmatrix, scales
+
+
+class Calibrator(inference.Predictor):
+    # float forward pass recording the range of the input of each layer
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ranges = [0.0] * (len(self.layers) - 1)
+
+    def linear(self, layer_num, act, z):
+        self.ranges[layer_num] = max(self.ranges[layer_num], float(np.percentile(np.abs(act), CALIBRATION_PERCENTILE)))
+        super().linear(layer_num, act, z)
+
+
+def quantize(weights, activation_functions, calibration_x, per_channel=True, batch_size=inference.BATCH_SIZE, mean=None, std=None, accumulation="float32"):
+    # post training quantization of (prev_layer + 1, next_layer) float weights
+    # the input scale of each layer is calibrated on the float activations of calibration_x, examples in rows
+    calibrator = Calibrator(weights, activation_functions, np.float32, batch_size, mean, std, max_density=0.0)
+    calibrator.predict_proba(calibration_x)
+    input_scales = np.maximum(calibrator.ranges, MIN_SCALE) / inference.INT8_MAX
+
+    quantized = [quantize_matrix(layer_weights[1:, :].transpose(), per_channel) for layer_weights in weights]
+    biases = [layer_weights[0, :].reshape(-1, 1) for layer_weights in weights]
+    return inference.QuantizedPredictor([qweights for qweights, _ in quantized], [scales for _, scales in quantized], biases, input_scales,
+                                        activation_functions, batch_size, mean, std, accumulation)
+
+
+if __name__ == '__main__':
+
+    # quantization.py <save_logs> <checkpoint .npz> <val> [<channel|layer> [<calibration examples> [<float32|int32>]]]
+    # int8 quantization calibrated on a sample of the validation set, reports the accuracy delta, speed and size against the float model
+    save_logs = sys.argv[1].lower() == 'true'
+    ckpt_path = sys.argv[2]
+    val_path = sys.argv[3]
+    per_channel = not (len(sys.argv) > 4 and sys.argv[4].lower() == "layer")
+    n_calibration = int(sys.argv[5]) if len(sys.argv) > 5 else CALIBRATION_EXAMPLES
+    accumulation = sys.argv[6].lower() if len(sys.argv) > 6 else "float32"
+
+    exp = "quantize_" + strftime("%Y.%m.%d_%H:%M:%S", gmtime())
+    if save_logs:
+        os.makedirs("./logs/" + exp, exist_ok=True)
+    log = logger.LOGGER("./logs/" + exp + "/log" if save_logs else None)
+
+    ckpt = checkpoint.read(ckpt_path, moments=False)
+    nn_params = ckpt["nn_params"]
+    dtype = Network.DTYPES[nn_params["dtype"]][0]
+
+    # validation batches are gathered once, the calibration examples are a random sample of them
+    val_set = img_classifier.read_data(val_path, "validation", nn_params["grayscale"])
+    batches = [(batched_data.transpose(), labels) for batched_data, labels in val_set.batches(inference.BATCH_SIZE)]
+    examples = np.concatenate([batched_data for batched_data, _ in batches])
+    calibration_x = examples[np.sort(np.random.RandomState(0).permutation(len(examples))[:n_calibration])]
+
+    float_predictor = inference.Predictor(ckpt["weights"], nn_params["activations"], dtype, inference.BATCH_SIZE, ckpt["mean"], ckpt["std"], max_density=0.0)
+    quantized = quantize(ckpt["weights"], nn_params["activations"], calibration_x, per_channel, inference.BATCH_SIZE, ckpt["mean"], ckpt["std"], accumulation)
+
+    results = {}
+    for name, predictor in [("float", float_predictor), ("int8", quantized)]:
+        accuracy, throughput = inference.measure(predictor, batches)
+        results[name] = {"val_acc": accuracy, "examples_per_sec": throughput, "weights_mb": predictor.weights_nbytes() / 2 ** 20}
+    results["acc_delta"] = results["int8"]["val_acc"] - results["float"]["val_acc"]
+    stored_mb = sum(layer_weights.nbytes for layer_weights in ckpt["weights"]) / 2 ** 20  # master weights as stored in the checkpoint
+    results["size_reduction"] = stored_mb / results["int8"]["weights_mb"]
+
+    header_template = "{0:<10}{1:<10}{2:<11}{3:<12}{4}"
+    row_template = "{0:<10}{1:<10.5f}{2:<+11.5f}{3:<12.1f}{4:.2f}"
+    log.log(header_template.format("Model", "Val_Acc", "Acc_Delta", "ex/s", "Weights_MB"))
+    log.log(row_template.format(np.dtype(dtype).name, results["float"]["val_acc"], 0.0, results["float"]["examples_per_sec"], results["float"]["weights_mb"]))
+    log.log(row_template.format("int8", results["int8"]["val_acc"], results["acc_delta"], results["int8"]["examples_per_sec"], results["int8"]["weights_mb"]))
+    log.log("int8 weights are {0:.1f}x smaller than the {1} checkpoint weights".format(results["size_reduction"], nn_params["dtype"]))
+
+    if save_logs:
+        checkpoint.write(quantized.arrays(nn_params), "./logs/" + exp + "/model_int8.npz")
+        with open("./logs/" + exp + "/report.json", 'w') as f:
+            json.dump(results, f, indent=2)
+    log.flush()
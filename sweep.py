@@ -0,0 +1,191 @@
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+import numpy as np
+import Network
+import img_classifier
+import logger
+import main
+import parallel
+import writer
+from time import gmtime, strftime
+
+# search space over nn_params keys, a list is a choice, {"uniform": [low, high]} and {"log_uniform": [low, high]} are ranges
+# a single dropout value is used on every layer, activations are relu with a softmax output when the layers change
+SEARCH_SPACE = {
+    "lr": {"log_uniform": [10 ** -4, 10 ** -2]},
+    "momentum": [0.8, 0.9, 0.95],
+    "reg_lambda": {"log_uniform": [10 ** -5, 10 ** -3]},
+    "dropout": [0.0, 0.2, 0.5],
+    "layers": [[3072, 1000, 10], [3072, 2000, 500, 10], [3072, 2000, 500, 2000, 10]],
+    "optimizer": ["SGD", "ADAM"],
+    "train_batch_size": [32, 64, 128],
+}
+
+MAX_EPOCHS = 27  # epochs of a trial that is never pruned
+MIN_EPOCHS = 1  # first epoch a trial can be pruned at
+REDUCTION = 3  # only the top 1/REDUCTION of the trials reaching a rung go on
+ADAM_SECOND_MOMENT = 0.999  # used when the base parameters have no second moment
+
+
+def sample(space, rng):
+    params = {}
+    for key, values in space.items():
+        if isinstance(values, dict) and "uniform" in values:
+            params[key] = float(rng.uniform(*values["uniform"]))
+        elif isinstance(values, dict) and "log_uniform" in values:
+            params[key] = float(np.exp(rng.uniform(*np.log(values["log_uniform"]))))
+        else:
+            params[key] = values[rng.randint(len(values))]
+    return params
+
+
+def trial_params(base, sampled):
+    # full nn_params of a trial, per layer lists follow the sampled layers
+    nn_params = dict(base)
+    nn_params.update(sampled)
+    n_layers = len(nn_params["layers"]) - 1
+    if np.isscalar(nn_params["dropout"]):
+        nn_params["dropout"] = [nn_params["dropout"]] * n_layers
+    if len(nn_params["activations"]) != n_layers:
+        nn_params["activations"] = ["relu"] * (n_layers - 1) + ["softmax"]
+    if len(nn_params["dropout"]) != n_layers:
+        nn_params["dropout"] = [nn_params["dropout"][0]] * n_layers
+    if nn_params["optimizer"].upper() == "ADAM" and nn_params["second_moment"] == 0:
+        nn_params["second_moment"] = ADAM_SECOND_MOMENT
+    nn_params["epochs"] = MAX_EPOCHS
+    nn_params["workers"] = 1  # trials are already spread on the processes
+    return nn_params
+
+
+def stats_key(nn_params):
+    # trials with the same grayscale and augmentations share the training set statistics
+    return json.dumps([nn_params["grayscale"], nn_params["augmentations"]], sort_keys=True)
+
+
+class SuccessiveHalving:
+    # asynchronous successive halving, a trial goes on from a rung when it is in the top 1/reduction of the trials that reached it
+    # rungs are at min_epochs * reduction ** k epochs below max_epochs, rungs and lock are shared by the trial processes
+
+    def __init__(self, rungs, lock, max_epochs=MAX_EPOCHS, min_epochs=MIN_EPOCHS, reduction=REDUCTION):
+        self.rungs = rungs  # rung epoch -> best validation accuracies of the trials that reached it
+        self.lock = lock
+        self.max_epochs = max_epochs  # a trial that reached max_epochs is done, it can not be pruned
+        self.min_epochs = min_epochs
+        self.reduction = reduction
+
+    def is_rung(self, epoch):
+        if epoch >= self.max_epochs:
+            return False
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.reduction
+        return rung == epoch
+
+    def keep(self, epoch, accuracy):
+        if not self.is_rung(epoch):
+            return True
+        with self.lock:
+            accuracies = self.rungs.get(epoch, []) + [accuracy]
+            self.rungs[epoch] = accuracies
+        # not enough trials reached the rung yet to rank this one
+        n_top = len(accuracies) // self.reduction
+        if n_top == 0:
+            return True
+        return accuracy >= sorted(accuracies)[-n_top]
+
+
+def run_trial(trial_num, nn_params, sweep, train_path, val_path, save_logs, rungs, lock, stats=None):
+    # stats - z score (mean, std) of the training set, computed once by the sweep
+    exp = sweep + "/trial_{0:03d}".format(trial_num)
+    if save_logs:
+        os.makedirs("./logs/" + exp, exist_ok=True)
+    log = logger.LOGGER("./logs/" + exp + "/log" if save_logs else None, echo=False)
+    for key, val in nn_params.items():
+        log.log("{0}: {1}".format(key, val))
+
+    pruner = SuccessiveHalving(rungs, lock, nn_params["epochs"])
+    result = {"trial": trial_num, "val_acc": 0.0, "val_loss": float("inf"), "epochs": 0, "pruned": False}
+
+    def on_epoch(epoch, val_loss, val_acc):
+        result["epochs"] = epoch
+        if val_acc > result["val_acc"]:
+            result["val_acc"], result["val_loss"] = float(val_acc), float(val_loss)
+        result["pruned"] = not pruner.keep(epoch, result["val_acc"])
+        return not result["pruned"]
+
+    start_time = time.time()
+    model = Network.Fully_Connected(nn_params)
+    img_classifier.train_model(model, nn_params, log, exp, train_path, val_path, save_logs, on_epoch, stats=stats)
+    writer.get_writer().flush()
+    result["time"] = time.time() - start_time
+    return result
+
+
+def ranked_table(results, sampled):
+    # results sorted by best validation accuracy, completed trials before pruned ones on ties
+    results = sorted(results, key=lambda result: (-result["val_acc"], result["pruned"], result["val_loss"]))
+    lines = ["{0:<6}{1:<7}{2:<10}{3:<11}{4:<8}{5:<9}{6}".format("Rank", "Trial", "Val_Acc", "Val_Loss", "Epochs", "Status", "Params")]
+    for rank, result in enumerate(results, 1):
+        lines.append("{0:<6}{1:<7}{2:<10.5f}{3:<11.5f}{4:<8}{5:<9}{6}".format(
+            rank, result["trial"], result["val_acc"], result["val_loss"], result["epochs"], "pruned" if result["pruned"] else "done", json.dumps(sampled[result["trial"]])))
+    return results, lines
+
+
+if __name__ == '__main__':
+
+    # sweep.py <save_logs> <trials> <processes> <train .csv> <val .csv> [<search space .json>]
+    save_logs = sys.argv[1].lower() == 'true'
+    n_trials = int(sys.argv[2])
+    n_processes = int(sys.argv[3])
+    train_path = sys.argv[4]
+    val_path = sys.argv[5]
+    space = SEARCH_SPACE
+    if len(sys.argv) > 6:
+        with open(sys.argv[6]) as f:
+            space = json.load(f)
+
+    sweep = "sweep_" + strftime("%Y.%m.%d_%H:%M:%S", gmtime())
+    os.makedirs("./logs/" + sweep, exist_ok=True)
+    log = logger.LOGGER("./logs/" + sweep + "/log")
+
+    # parse the csv files (or CIFAR batches) once, the trials map the same cached arrays
+    log.log("Cache Train and Validation Data")
+    img_classifier.read_data(train_path)
+    img_classifier.read_data(val_path)
+
+    rng = np.random.RandomState()
+    sampled = [sample(space, rng) for _ in range(n_trials)]
+    trials = [trial_params(main.nn_params, params) for params in sampled]
+
+    # z score statistics in a single pass over the training data for each input pipeline of the trials
+    stats = {}
+    for nn_params in trials:
+        if nn_params["z_scale"] and stats_key(nn_params) not in stats:
+            stats[stats_key(nn_params)] = img_classifier.read_train_data(train_path, nn_params).feature_stats()
+
+    # trials run in their own processes, BLAS threads are split between them
+    context = mp.get_context("spawn")
+    manager = context.Manager()
+    rungs, lock = manager.dict(), manager.Lock()
+    with parallel.blas_threads(max(1, (os.cpu_count() or 1) // n_processes)):
+        pool = context.Pool(n_processes)
+
+    results = []
+    with pool:
+        pending = [pool.apply_async(run_trial, (trial_num, nn_params, sweep, train_path, val_path, save_logs, rungs, lock, stats.get(stats_key(nn_params))))
+                   for trial_num, nn_params in enumerate(trials)]
+        for task in pending:
+            result = task.get()
+            results.append(result)
+            log.log("Trial {0}: val acc {1:.5f} after {2} epochs{3} ({4:.1f}s)".format(
+                result["trial"], result["val_acc"], result["epochs"], ", pruned" if result["pruned"] else "", result["time"]))
+
+    results, lines = ranked_table(results, sampled)
+    for line in lines:
+        log.log(line)
+    with open("./logs/" + sweep + "/results.json", 'w') as f:
+        json.dump([dict(result, params=sampled[result["trial"]]) for result in results], f, indent=2)
+    log.flush()
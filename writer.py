@@ -0,0 +1,106 @@
+import atexit
+import os
+import queue
+import threading
+import numpy as np
+
+MAX_PENDING = 64  # tasks waiting to be written before the caller blocks
+
+
+def atomic_save_text(path, array, fmt):
+    # write to a temporary file and rename it so readers never see a partial file
+    tmp_path = path + ".tmp"
+    np.savetxt(tmp_path, array, fmt=fmt)
+    os.replace(tmp_path, path)
+
+
+def append_rows(path, rows, fmt):
+    with open(path, 'a') as f:
+        np.savetxt(f, rows, fmt=fmt)
+
+
+class AsyncWriter:
+    # writes logs, metrics and artifacts on a background thread, consecutive log lines of a file are written at once
+
+    def __init__(self):
+        self.tasks = queue.Queue(MAX_PENDING)
+        self.error = None  # first error raised on the writer thread, raised again on the caller thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            tasks = [self.tasks.get()]
+            while True:
+                try:
+                    tasks.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    break
+
+            # batch the lines appended to each file, other tasks keep their order
+            lines = {}
+            for task in tasks:
+                if task[0] == "lines":
+                    lines.setdefault(task[1], []).extend(task[2])
+                else:
+                    self.write_lines(lines)
+                    lines = {}
+                    self.execute(task[1], task[2], task[3])
+            self.write_lines(lines)
+
+            for _ in tasks:
+                self.tasks.task_done()
+
+    def execute(self, fn, args, kwargs={}):
+        if self.error is not None:
+            return
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def write_lines(self, lines):
+        for path, path_lines in lines.items():
+            self.execute(self.append_text, (path, "".join(path_lines)))
+
+    @staticmethod
+    def append_text(path, text):
+        with open(path, 'a') as f:
+            f.write(text)
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        # run fn(*args, **kwargs) on the writer thread, arrays passed must not be modified afterwards
+        self.check_error()
+        self.tasks.put(("call", fn, args, kwargs))
+
+    def append_lines(self, path, lines):
+        self.check_error()
+        self.tasks.put(("lines", path, list(lines)))
+
+    def append_rows(self, path, rows, fmt='%.18e'):
+        self.submit(append_rows, path, rows, fmt)
+
+    def save_text(self, path, array, fmt='%.18e'):
+        self.submit(atomic_save_text, path, array, fmt)
+
+    def flush(self):
+        # wait until everything submitted is on disk
+        self.tasks.join()
+        self.check_error()
+
+
+WRITER = None
+
+
+def get_writer():
+    # writer shared by the logger and the training loop, started on first use
+    global WRITER
+    if WRITER is None:
+        WRITER = AsyncWriter()
+    return WRITER